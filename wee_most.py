@@ -2,23 +2,32 @@
 # Released under the GNU GPLv3 license.
 # Forked from wee_matter, inspired by wee_slack
 
+import http.client
 import json
 import os
 import platform
+import queue
+import random
 import re
 import shutil
 import socket
+import sqlite3
+import ssl
 import subprocess
 import tempfile
+import threading
 import time
+import urllib.parse
 import urllib.request
 import weechat
+import zlib
 
-from collections import namedtuple
+from collections import OrderedDict, deque, namedtuple
 from functools import wraps
 from ssl import SSLWantReadError
-from websocket import (create_connection, WebSocketConnectionClosedException,
-                       WebSocketTimeoutException, ABNF)
+from websocket import (create_connection, WebSocket, WebSocketBadStatusException,
+                       WebSocketConnectionClosedException, WebSocketTimeoutException,
+                       ABNF, frame_buffer)
 
 class Config:
 
@@ -98,6 +107,10 @@ class Config:
             self.sections["look"], "channel_loading_indicator", "string",
             "Indicator for channels being loaded with content",
             "", 0, 0, "…", "…", 0, "", "", "", "", "", ""), "type": "string" }
+        self.options["look.channel_not_loaded_indicator"] = { "pointer": weechat.config_new_option(self.file,
+            self.sections["look"], "channel_not_loaded_indicator", "string",
+            "Indicator for channels whose content is not loaded yet",
+            "", 0, 0, "~", "~", 0, "", "", "", "", "", ""), "type": "string" }
         self.options["look.channel_prefix_direct_away"] = { "pointer": weechat.config_new_option(self.file,
             self.sections["look"], "channel_prefix_direct_away", "string",
             "The prefix of buffer names for direct messages channels if user status is \"away\"",
@@ -134,6 +147,14 @@ class Config:
             self.sections["look"], "edited_suffix", "string",
             "The suffix for edited posts",
             "", 0, 0, "(edited)", "(edited)", 0, "", "", "", "", "", ""), "type": "string" }
+        self.options["look.pending_suffix"] = { "pointer": weechat.config_new_option(self.file,
+            self.sections["look"], "pending_suffix", "string",
+            "The suffix for posts not sent yet",
+            "", 0, 0, "(pending)", "(pending)", 0, "", "", "", "", "", ""), "type": "string" }
+        self.options["look.failed_suffix"] = { "pointer": weechat.config_new_option(self.file,
+            self.sections["look"], "failed_suffix", "string",
+            "The suffix for posts that could not be sent",
+            "", 0, 0, "(not sent)", "(not sent)", 0, "", "", "", "", "", ""), "type": "string" }
         self.options["look.nick_full_name"] = { "pointer": weechat.config_new_option(self.file,
             self.sections["look"], "nick_full_name", "boolean",
             "Use full name instead of username as nick",
@@ -220,6 +241,14 @@ class Config:
             self.sections["color"], "file_url", "color",
             "Color for the URL part of a file",
             "", 0, 0, "default", "default", 0, "", "", "", "", "", ""), "type": "color" }
+        self.options["color.pending_suffix"] = { "pointer": weechat.config_new_option(self.file,
+            self.sections["color"], "pending_suffix", "color",
+            "Color for pending suffix on posts not sent yet",
+            "", 0, 0, "darkgray", "darkgray", 0, "", "", "", "", "", ""), "type": "color" }
+        self.options["color.failed_suffix"] = { "pointer": weechat.config_new_option(self.file,
+            self.sections["color"], "failed_suffix", "color",
+            "Color for failed suffix on posts that could not be sent",
+            "", 0, 0, "red", "red", 0, "", "", "", "", "", ""), "type": "color" }
         self.options["color.reaction"] = { "pointer": weechat.config_new_option(self.file,
             self.sections["color"], "reaction", "color",
             "Color for the messages reactions",
@@ -257,6 +286,45 @@ class Config:
             "Location for storing downloaded files",
             "", 0, 0, download_dir, download_dir, 0, "", "", "", "", "", ""), "type": "string" }
 
+        # network
+        self.sections["network"] = weechat.config_new_section(self.file, "network", 0, 0, "", "", "", "", "", "", "", "", "", "")
+        self.options["network.max_concurrent_requests"] = { "pointer": weechat.config_new_option(self.file,
+            self.sections["network"], "max_concurrent_requests", "integer",
+            "Maximum number of requests in flight at the same time for each server",
+            "", 1, 64, "8", "8", 0, "", "", "", "", "", ""), "type": "integer" }
+        self.options["network.connection_pool_size"] = { "pointer": weechat.config_new_option(self.file,
+            self.sections["network"], "connection_pool_size", "integer",
+            "Number of persistent HTTP connections kept open to each server, 0 to use WeeChat URL transfer with one process per request (always used when weechat.network.proxy_curl is set)",
+            "", 0, 32, "4", "4", 0, "", "", "", "", "", ""), "type": "integer" }
+        self.options["network.request_retries"] = { "pointer": weechat.config_new_option(self.file,
+            self.sections["network"], "request_retries", "integer",
+            "Number of times a failed request without side effects is sent again, with an exponential backoff",
+            "", 0, 10, "3", "3", 0, "", "", "", "", "", ""), "type": "integer" }
+        self.options["network.lazy_channel_loading"] = { "pointer": weechat.config_new_option(self.file,
+            self.sections["network"], "lazy_channel_loading", "boolean",
+            "Only load on connection the channels with unread messages or mentions, the others are loaded when their buffer is first displayed",
+            "", 0, 0, "off", "off", 0, "", "", "", "", "", ""), "type": "boolean" }
+        self.options["network.websocket_reader_thread"] = { "pointer": weechat.config_new_option(self.file,
+            self.sections["network"], "websocket_reader_thread", "boolean",
+            "Read and decode websocket frames in a dedicated thread, the events are then handled by the main loop within a time budget per tick (applies to new connections)",
+            "", 0, 0, "off", "off", 0, "", "", "", "", "", ""), "type": "boolean" }
+        self.options["network.websocket_compression"] = { "pointer": weechat.config_new_option(self.file,
+            self.sections["network"], "websocket_compression", "boolean",
+            "Ask the server to compress websocket messages (permessage-deflate), falls back to an uncompressed connection if refused (applies to new connections)",
+            "", 0, 0, "off", "off", 0, "", "", "", "", "", ""), "type": "boolean" }
+        self.options["network.websocket_drain_time"] = { "pointer": weechat.config_new_option(self.file,
+            self.sections["network"], "websocket_drain_time", "integer",
+            "Maximum time in milliseconds spent handling websocket events per main loop tick, the rest is handled on the next tick",
+            "", 1, 1000, "20", "20", 0, "", "", "", "", "", ""), "type": "integer" }
+        self.options["network.websocket_drain_count"] = { "pointer": weechat.config_new_option(self.file,
+            self.sections["network"], "websocket_drain_count", "integer",
+            "Maximum number of websocket events handled per main loop tick, the rest is handled on the next tick",
+            "", 1, 100000, "200", "200", 0, "", "", "", "", "", ""), "type": "integer" }
+        self.options["network.trace_startup"] = { "pointer": weechat.config_new_option(self.file,
+            self.sections["network"], "trace_startup", "boolean",
+            "Time the phases of the connection to a server, the report is printed in the server buffer and written as JSON in the WeeChat data directory",
+            "", 0, 0, "off", "off", 0, "", "", "", "", "", ""), "type": "boolean" }
+
         # server (user can add options)
         self.sections["server"] = weechat.config_new_section(self.file, "server", 1, 0, "", "", "", "", "", "", "create_server_option_cb", "", "", "")
         self.options["server.autoconnect"] = { "pointer": weechat.config_new_option(self.file,
@@ -357,6 +425,9 @@ def nick_completion_cb(data, completion_item, current_buffer, completion):
     if not channel:
         return weechat.WEECHAT_RC_OK
 
+    # the completed buffer is the displayed one, its nicklist is due anyway
+    channel.populate_nicklist()
+
     for user in channel.users.values():
         weechat.completion_list_add(completion, user.username, 1, weechat.WEECHAT_LIST_POS_SORT)
         weechat.completion_list_add(completion, "@{}".format(user.username), 1, weechat.WEECHAT_LIST_POS_SORT)
@@ -407,6 +478,12 @@ commands = [
         description = "disconnect from a server",
         completion = "%(mattermost_server_commands)",
     ),
+    Command(
+        name = "stats",
+        args = "[<server-name>]",
+        description = "show requests statistics",
+        completion = "%(mattermost_server_commands)",
+    ),
     Command(
         name = "slash",
         args = "<mattermost-command>",
@@ -478,6 +555,27 @@ def command_disconnect(args, buffer):
         return weechat.WEECHAT_RC_ERROR
     return disconnect_server(args)
 
+def command_stats(args, buffer):
+    if 1 < len(args.split()):
+        write_command_error("stats {}".format(args), "Error with subcommand arguments")
+        return weechat.WEECHAT_RC_ERROR
+
+    if args:
+        if args not in servers:
+            write_command_error("stats {}".format(args), "Unknown server")
+            return weechat.WEECHAT_RC_ERROR
+        stats_servers = [ servers[args] ]
+    elif get_server_from_buffer(buffer):
+        stats_servers = [ get_server_from_buffer(buffer) ]
+    else:
+        stats_servers = list(servers.values())
+
+    for server in stats_servers:
+        EVENTROUTER.print_stats(server)
+        print_ws_stats(server)
+
+    return weechat.WEECHAT_RC_OK
+
 def command_server(args, buffer):
     if 0 == len(args.split()):
         write_command_error("server {}".format(args), "Error with subcommand arguments")
@@ -505,7 +603,10 @@ def command_slash(args, buffer):
     else:
         team_id = list(server.teams.keys())[0]
 
-    run_post_command(team_id, channel.id, "/{}".format(args), server, "singularity_cb", buffer)
+    EVENTROUTER.enqueue_request(
+        post_command_request(team_id, channel.id, "/{}".format(args), server, singularity_cb, buffer),
+        priority=PRIORITY_INTERACTIVE
+    )
 
     return weechat.WEECHAT_RC_OK
 
@@ -541,7 +642,7 @@ def command_reply(args, buffer):
         "root_id": post,
     }
 
-    run_post_post(new_post, server, "post_post_cb", buffer)
+    server.outbox.add_post(new_post, buffer)
 
     return weechat.WEECHAT_RC_OK
 
@@ -558,7 +659,7 @@ def command_react(args, buffer):
     channel = server.get_channel_from_buffer(buffer)
     post_id = _get_post_id(channel, post_id)
 
-    run_post_reaction(emoji_name, post_id, server, "singularity_cb", buffer)
+    server.outbox.add({ "type": "reaction", "post_id": post_id, "emoji_name": emoji_name }, buffer)
 
     return weechat.WEECHAT_RC_OK
 
@@ -575,7 +676,7 @@ def command_unreact(args, buffer):
     channel = server.get_channel_from_buffer(buffer)
     post_id = _get_post_id(channel, post_id)
 
-    run_delete_reaction(emoji_name, post_id, server, "singularity_cb", buffer)
+    server.outbox.add({ "type": "unreaction", "post_id": post_id, "emoji_name": emoji_name }, buffer)
 
     return weechat.WEECHAT_RC_OK
 
@@ -587,7 +688,7 @@ def command_delete(args, buffer):
 
     server = get_server_from_buffer(buffer)
 
-    run_delete_post(args, server, "singularity_cb", buffer)
+    server.outbox.add({ "type": "delete", "post_id": args }, buffer)
 
     return weechat.WEECHAT_RC_OK
 
@@ -633,15 +734,17 @@ class File:
                 self.server.print_error("Failed to create directory for downloads: {}".format(self.dir_path))
                 return
 
-        run_get_file(self.id, file_path, self.server, "file_get_cb", "{}|{}|{}".format(self.server.id, file_path, int(open)))
+        EVENTROUTER.enqueue_request(
+            get_file_request(self.id, file_path, self.server, file_get_cb, (self.server, file_path, open)),
+            priority=PRIORITY_INTERACTIVE
+        )
 
     @staticmethod
     def open(path):
         weechat.hook_process('xdg-open "{}"'.format(path), 0, "", "")
 
-def file_get_cb(data, command, rc, out, err):
-    server_id, file_path, open = data.split("|")
-    server = servers[server_id]
+def file_get_cb(ctx, rc, out, err):
+    server, file_path, open = ctx
 
     if rc != 0:
         server.print_error("An error occurred while downloading file")
@@ -663,8 +766,9 @@ class Post:
         self.read = False
         self.edited = kwargs["edit_at"] != 0
         self.thread_root = False
+        self.pending_post_id = kwargs.get("pending_post_id")
 
-        self.user = server.users[kwargs["user_id"]]
+        self.user = server.get_user(kwargs["user_id"])
 
         self.files = {}
         if "metadata" in kwargs and "files" in kwargs["metadata"]:
@@ -820,7 +924,7 @@ class Post:
 
 class Reaction:
     def __init__(self, server, **kwargs):
-        self.user = server.users[kwargs["user_id"]]
+        self.user = server.get_user(kwargs["user_id"])
         self.emoji_name = kwargs["emoji_name"]
         self.id = "{}_{}".format(self.user, self.emoji_name)
 
@@ -876,15 +980,6 @@ class Attachment:
 
         return format_markdown_links("\n".join(att))
 
-def post_post_cb(buffer, command, rc, out, err):
-    server = get_server_from_buffer(buffer)
-
-    if rc != 0:
-        server.print_error("Cannot send post")
-        return weechat.WEECHAT_RC_ERROR
-
-    return weechat.WEECHAT_RC_OK
-
 def colorize(sentence, color):
     return "{}{}{}".format(weechat.color(color), sentence, weechat.color("reset"))
 
@@ -956,6 +1051,13 @@ def is_post_line_data(line_data, post_id):
         if tag.startswith(post_id_tag):
             return True
 
+def get_line_data_post_id(line_data):
+    for tag in get_line_data_tags(line_data):
+        if tag.startswith("post_id_"):
+            return tag[len("post_id_"):]
+
+    return None
+
 def find_buffer_last_post_line_data(buffer, post_id):
     lines = weechat.hdata_pointer(weechat.hdata_get("buffer"), buffer, "lines")
     line = weechat.hdata_pointer(weechat.hdata_get("lines"), lines, "last_line")
@@ -1004,11 +1106,16 @@ class ChannelBase:
         self.title = kwargs["header"]
         self.server = server
         self.name = self._format_name(kwargs["display_name"], kwargs["name"])
+        self.total_msg_count = kwargs.get("total_msg_count", 0)
         self.buffer = None
         self.posts = {}
+        self.dirty_post_ids = set()
+        self.user_ids = set()
         self.users = {}
+        self.nicklist_populated = False
         self._is_loading = False
         self._is_muted = None
+        self.loaded = False
         self.last_post_id = None
         self.last_read_post_id = None
 
@@ -1034,6 +1141,8 @@ class ChannelBase:
         prefix = ""
         if self._is_loading:
             prefix += config.get_value("look", "channel_loading_indicator")
+        elif not self.loaded:
+            prefix += config.get_value("look", "channel_not_loaded_indicator")
 
         color = ""
         if self._is_muted:
@@ -1047,22 +1156,30 @@ class ChannelBase:
         else:
             self.unmute()
 
+        self.loaded = True
         self.set_loading(True)
+        self.server.tracer.start("hydration")
 
         EVENTROUTER.enqueue_request(
-            "run_get_read_channel_posts",
-            self.id, self.server, "hydrate_channel_read_posts_cb", self.buffer
+            get_read_channel_posts_request(self.id, self.server, hydrate_channel_read_posts_cb, self, self),
+            priority=self.request_priority()
         )
 
         EVENTROUTER.enqueue_request(
-            "run_get_channel_members",
-            self.id, self.server, 0, "hydrate_channel_users_cb", "{}|{}|0".format(self.server.id, self.id)
+            get_channel_members_request(self.id, self.server, 0, hydrate_channel_users_cb, (self, 0), self),
+            priority=self.request_priority()
         )
 
+    def request_priority(self):
+        if self.buffer == weechat.current_buffer():
+            return PRIORITY_VISIBLE
+        return PRIORITY_BACKGROUND
+
     def update_properties(self, channel_data):
         self.name = self._format_name(channel_data["display_name"], channel_data["name"])
         self.title = channel_data["header"]
-        weechat.buffer_set(self.buffer, "short_name", self.name)
+        self.total_msg_count = channel_data.get("total_msg_count", 0)
+        self._update_buffer_name()
         weechat.buffer_set(self.buffer, "title", self.title)
 
     def _update_file_tags(self, post_id):
@@ -1134,10 +1251,26 @@ class ChannelBase:
     def edit_post(self, post):
         post.edited = True
         self.posts[post.id] = post
-        self.update_post(post)
+        self.queue_post_update(post.id)
 
-    def update_post(self, post):
-        pointers = self._get_lines_pointers(post.id)
+    def queue_post_update(self, post_id):
+        # a post touched by many events in a row is only rendered once
+        self.dirty_post_ids.add(post_id)
+        self.server.schedule_post_updates(self)
+
+    def flush_post_updates(self):
+        post_ids = self.dirty_post_ids
+        self.dirty_post_ids = set()
+
+        posts = [ self.posts[post_id] for post_id in post_ids if post_id in self.posts ]
+        posts_pointers = self._get_posts_lines_pointers([ post.id for post in posts ])
+
+        for post in posts:
+            self.update_post(post, posts_pointers.get(post.id, []))
+
+    def update_post(self, post, pointers=None):
+        if pointers is None:
+            pointers = self._get_lines_pointers(post.id)
         if not pointers:
             return
 
@@ -1174,6 +1307,97 @@ class ChannelBase:
 
         return pointers
 
+    def _get_posts_lines_pointers(self, post_ids):
+        # same as _get_lines_pointers for several posts, in a single pass over the buffer
+        post_ids = set(post_ids)
+        if not post_ids:
+            return {}
+
+        lines = weechat.hdata_pointer(weechat.hdata_get("buffer"), self.buffer, "lines")
+        line = weechat.hdata_pointer(weechat.hdata_get("lines"), lines, "last_line")
+
+        posts_pointers = {}
+        found_post_ids = set()
+        previous_post_id = None
+        while line and found_post_ids != post_ids:
+            line_data = weechat.hdata_pointer(weechat.hdata_get("line"), line, "data")
+            post_id = get_line_data_post_id(line_data)
+
+            # only the last lines of a post are kept, like when searched alone
+            if post_id != previous_post_id and previous_post_id in posts_pointers:
+                found_post_ids.add(previous_post_id)
+
+            if post_id in post_ids and post_id not in found_post_ids:
+                posts_pointers.setdefault(post_id, []).append(line)
+
+            previous_post_id = post_id
+            line = weechat.hdata_pointer(weechat.hdata_get("line"), line, "prev_line")
+
+        for pointers in posts_pointers.values():
+            pointers.reverse()
+
+        return posts_pointers
+
+    def _render_pending_post(self, post, suffix, lines_count=None):
+        message = post.render_message(lines_count=lines_count)
+        message += " {}".format(colorize(config.get_value("look", suffix), config.get_value("color", suffix)))
+        if post.root_id:
+            message = self._prefix_thread_message(message, post.root_id, root=False)
+
+        return message
+
+    def write_pending_post(self, post):
+        tags = "post_id_{},notify_none,no_highlight,no_log".format(post.id)
+
+        message = self._render_pending_post(post, "pending_suffix")
+
+        weechat.prnt_date_tags(self.buffer, post.date, tags, "{}\t".format(post.render_nick()) + message)
+
+    def fail_pending_post(self, post):
+        pointers = self._get_lines_pointers(post.id)
+        if not pointers:
+            return
+
+        message = self._render_pending_post(post, "failed_suffix", lines_count=len(pointers))
+
+        for pointer, line in zip(pointers, message.split("\n")):
+            line_data = weechat.hdata_pointer(weechat.hdata_get("line"), pointer, "data")
+            weechat.hdata_update(weechat.hdata_get("line_data"), line_data, {"message": line})
+
+    def confirm_pending_post(self, pending_post_id, post):
+        pointers = self._get_lines_pointers(pending_post_id)
+        if not pointers:
+            return False
+
+        self.posts[post.id] = post
+
+        root_post = self.posts.get(post.root_id)
+        if root_post:
+            root_post.thread_root = True
+            self.update_post(root_post)
+
+        message = post.render_message(lines_count=len(pointers)) + post.render_reactions()
+        if post.root_id:
+            message = self._prefix_thread_message(message, post.root_id, root=False)
+
+        tags = "post_id_{},no_highlight".format(post.id)
+
+        for pointer, line in zip(pointers, message.split("\n")):
+            line_data = weechat.hdata_pointer(weechat.hdata_get("line"), pointer, "data")
+            weechat.hdata_update(weechat.hdata_get("line_data"), line_data, {"message": line, "tags_array": tags})
+
+        self.last_post_id = post.id
+
+        return True
+
+    def _render_prefix(self, post):
+        if post.type in [ "system_join_channel", "system_join_team" ]:
+            return weechat.prefix("join")
+        elif post.type in [ "system_leave_channel", "system_leave_team" ]:
+            return weechat.prefix("quit")
+
+        return "{}\t".format(post.render_nick())
+
     def write_post(self, post):
         self.posts[post.id] = post
 
@@ -1197,11 +1421,7 @@ class ChannelBase:
         if post.user == self.server.me:
             tags += ",no_highlight"
 
-        prefix = "{}\t".format(post.render_nick())
-        if post.type in [ "system_join_channel", "system_join_team" ]:
-            prefix = weechat.prefix("join")
-        elif post.type in [ "system_leave_channel", "system_leave_team" ]:
-            prefix = weechat.prefix("quit")
+        prefix = self._render_prefix(post)
 
         message = post.render_message() + post.render_reactions()
         if post.root_id:
@@ -1217,15 +1437,30 @@ class ChannelBase:
         if self.last_post_id and self.last_post_id == self.last_read_post_id: # prevent spamming on buffer switch
             return
 
-        run_post_channel_view(self.id, self.server, "singularity_cb", self.buffer)
+        EVENTROUTER.enqueue_request(
+            post_channel_view_request(self.id, self.server, singularity_cb, self.buffer, self),
+            priority=PRIORITY_INTERACTIVE
+        )
 
         self.last_read_post_id = self.last_post_id
 
     def add_user(self, user_id):
-        if user_id not in self.server.users:
+        self.user_ids.add(user_id)
+
+        if self.nicklist_populated:
+            self._add_nick(user_id)
+
+    def populate_nicklist(self):
+        if self.nicklist_populated:
             return
 
-        user = self.server.users[user_id]
+        self.nicklist_populated = True
+
+        for user_id in self.user_ids:
+            self._add_nick(user_id)
+
+    def _add_nick(self, user_id):
+        user = self.server.get_user(user_id)
 
         if user.deleted:
             return
@@ -1239,11 +1474,43 @@ class ChannelBase:
         weechat.nicklist_add_nick(self.buffer, "", user.nick, color, "", color, 1)
 
     def remove_user(self, user_id):
+        self.user_ids.discard(user_id)
+
         user = self.users.pop(user_id, None)
         if user:
             nick = weechat.nicklist_search_nick(self.buffer, "", user.nick)
             weechat.nicklist_remove_nick(self.buffer, nick)
 
+    def refresh_users(self, old_nicks):
+        for user_id, old_nick in old_nicks.items():
+            user = self.users.get(user_id)
+            if not user:
+                continue
+
+            nick = weechat.nicklist_search_nick(self.buffer, "", old_nick)
+            weechat.nicklist_remove_nick(self.buffer, nick)
+
+            if user.deleted:
+                del self.users[user_id]
+                self.user_ids.discard(user_id)
+            else:
+                self.update_nicklist_user(user)
+
+        self.remove_empty_nick_groups()
+
+        authored_posts = [ p for p in self.posts.values() if p.user.id in old_nicks ]
+        reacted_posts = [ p for p in self.posts.values() if any([ r.user.id in old_nicks for r in p.reactions.values() ]) ]
+        posts_pointers = self._get_posts_lines_pointers([ p.id for p in authored_posts + reacted_posts ])
+
+        for post in authored_posts:
+            prefix = self._render_prefix(post)
+            for pointer in posts_pointers.get(post.id, []):
+                line_data = weechat.hdata_pointer(weechat.hdata_get("line"), pointer, "data")
+                weechat.hdata_update(weechat.hdata_get("line_data"), line_data, {"prefix": prefix.rstrip("\t")})
+
+        for post in reacted_posts:
+            self.update_post(post, posts_pointers.get(post.id, []))
+
     def update_nicklist(self):
         for user in self.users.values():
             self.update_nicklist_user(user)
@@ -1282,9 +1549,15 @@ class ChannelBase:
         self._is_loading = loading
         self._update_buffer_name()
 
+        if not loading:
+            self.server.tracer.channel_hydrated()
+
     def is_loading(self):
         return self._is_loading
 
+    def is_muted(self):
+        return self._is_muted
+
     def mute(self):
         self._is_muted = True
         self._update_buffer_name()
@@ -1326,6 +1599,9 @@ class ChannelBase:
         return config.get_value("look", "channel_prefix_{}".format(self.type)) + final_name
 
     def unload(self):
+        EVENTROUTER.cancel_requests(self.server.id, self)
+        self.server.presence_batcher.cancel(self)
+
         weechat.buffer_close(self.buffer)
         self.buffer = None
 
@@ -1343,6 +1619,8 @@ class DirectMessagesChannel(ChannelBase):
         prefix = ""
         if self._is_loading:
             prefix += config.get_value("look", "channel_loading_indicator")
+        elif not self.loaded:
+            prefix += config.get_value("look", "channel_not_loaded_indicator")
 
         if NICK_GROUPS.get(self._status):
             prefix += config.get_value("look", "channel_prefix_direct_{}".format(self._status))
@@ -1363,12 +1641,20 @@ class DirectMessagesChannel(ChannelBase):
     def _get_user(self, name):
         match = re.match("(\w+)__(\w+)", name)
 
-        user = self.server.users[match.group(1)]
+        user = self.server.get_user(match.group(1))
         if user == self.server.me:
-            user = self.server.users[match.group(2)]
+            user = self.server.get_user(match.group(2))
 
         return user
 
+    def refresh_users(self, old_nicks):
+        super(DirectMessagesChannel, self).refresh_users(old_nicks)
+
+        if self.user.id in old_nicks:
+            self.name = self.user.nick
+            weechat.buffer_set(self.buffer, "name", self._format_buffer_name())
+            self._update_buffer_name()
+
 class GroupChannel(ChannelBase):
     def __init__(self, server, **kwargs):
         super(GroupChannel, self).__init__(server, **kwargs)
@@ -1399,19 +1685,17 @@ def channel_input_cb(data, buffer, input_data):
         "message": input_data,
     }
 
-    run_post_post(post, server, "post_post_cb", buffer)
+    server.outbox.add_post(post, buffer)
 
     return weechat.WEECHAT_RC_OK
 
-def hydrate_channel_posts_cb(buffer, command, rc, out, err):
-    server = get_server_from_buffer(buffer)
+def hydrate_channel_posts_cb(channel, rc, out, err):
+    server = channel.server
 
     if rc != 0:
         server.print_error("An error occurred while hydrating channel")
         return weechat.WEECHAT_RC_ERROR
 
-    channel = server.get_channel_from_buffer(buffer)
-
     response = json.loads(out)
 
     for post_id in reversed(response["order"]):
@@ -1420,23 +1704,21 @@ def hydrate_channel_posts_cb(buffer, command, rc, out, err):
 
     if "" != response["next_post_id"]:
         EVENTROUTER.enqueue_request(
-            "run_get_channel_posts_after",
-            builded_post.id, builded_post.channel.id, server, "hydrate_channel_posts_cb", buffer
+            get_channel_posts_after_request(builded_post.id, channel.id, server, hydrate_channel_posts_cb, channel, channel),
+            priority=channel.request_priority()
         )
     else:
         channel.set_loading(False)
 
     return weechat.WEECHAT_RC_OK
 
-def hydrate_channel_read_posts_cb(buffer, command, rc, out, err):
-    server = get_server_from_buffer(buffer)
+def hydrate_channel_read_posts_cb(channel, rc, out, err):
+    server = channel.server
 
     if rc != 0:
         server.print_error("An error occurred while hydrating channel")
         return weechat.WEECHAT_RC_ERROR
 
-    channel = server.get_channel_from_buffer(buffer)
-
     response = json.loads(out)
 
     if not response["order"]:
@@ -1450,24 +1732,22 @@ def hydrate_channel_read_posts_cb(buffer, command, rc, out, err):
 
     channel.last_read_post_id = post.id
 
-    weechat.buffer_set(buffer, "unread", "-")
-    weechat.buffer_set(buffer, "hotlist", "-1")
+    weechat.buffer_set(channel.buffer, "unread", "-")
+    weechat.buffer_set(channel.buffer, "hotlist", "-1")
 
     if "" != response["next_post_id"]:
         EVENTROUTER.enqueue_request(
-            "run_get_channel_posts_after",
-            post.id, post.channel.id, server, "hydrate_channel_posts_cb", buffer
+            get_channel_posts_after_request(post.id, channel.id, server, hydrate_channel_posts_cb, channel, channel),
+            priority=channel.request_priority()
         )
     else:
         channel.set_loading(False)
 
     return weechat.WEECHAT_RC_OK
 
-def hydrate_channel_users_cb(data, command, rc, out, err):
-    server_id, channel_id, page = data.split("|")
-    page = int(page)
-    server = servers[server_id]
-    channel = server.get_channel(channel_id)
+def hydrate_channel_users_cb(ctx, rc, out, err):
+    channel, page = ctx
+    server = channel.server
 
     if rc != 0:
         server.print_error("An error occurred while hydrating channel users")
@@ -1477,19 +1757,20 @@ def hydrate_channel_users_cb(data, command, rc, out, err):
 
     if len(response) == 200:
         EVENTROUTER.enqueue_request(
-            "run_get_channel_members",
-            channel.id, server, page+1, "hydrate_channel_users_cb", "{}|{}|{}".format(server_id, channel_id, page+1)
+            get_channel_members_request(channel.id, server, page+1, hydrate_channel_users_cb, (channel, page+1), channel),
+            priority=channel.request_priority()
         )
 
     for user_data in response:
         channel.add_user(user_data["user_id"])
 
+    if channel.buffer == weechat.current_buffer():
+        channel.populate_nicklist()
+
     return weechat.WEECHAT_RC_OK
 
-def update_channel_mute_status_cb(data, command, rc, out, err):
-    server_id, page = data.split("|")
-    page = int(page)
-    server = servers[server_id]
+def update_channel_mute_status_cb(ctx, rc, out, err):
+    server, page = ctx
 
     if rc != 0:
         server.print_error("An error occurred while updating channel mute status")
@@ -1499,22 +1780,16 @@ def update_channel_mute_status_cb(data, command, rc, out, err):
 
     if len(response) == 100:
         EVENTROUTER.enqueue_request(
-            "run_get_user_channel_members",
-            server, page+1, "update_channel_mute_status_cb", "{}|{}".format(server_id, page+1)
+            get_user_channel_members_request(server, page+1, update_channel_mute_status_cb, (server, page+1))
         )
 
     for member_data in response:
-        channel = server.get_channel(member_data["channel_id"])
-        if channel:
-            muted = member_data["notify_props"]["mark_unread"] != "all"
-            channel.load(muted)
+        update_channel_mute_status(server, member_data)
 
     return weechat.WEECHAT_RC_OK
 
-def hydrate_channel_users_status_cb(data, command, rc, out, err):
-    server_id, channel_id = data.split("|")
-    server = servers[server_id]
-    channel = server.get_channel(channel_id)
+def hydrate_channel_users_status_cb(channel, rc, out, err):
+    server = channel.server
 
     if rc != 0:
         server.print_error("An error occurred while hydrating channel users status")
@@ -1533,9 +1808,7 @@ def hydrate_channel_users_status_cb(data, command, rc, out, err):
 
     return weechat.WEECHAT_RC_OK
 
-def update_direct_message_channels_name(server_id, command, rc, out, err):
-    server = servers[server_id]
-
+def update_direct_message_channels_name(server, rc, out, err):
     if rc != 0:
         server.print_error("An error occurred while updating direct message channels name")
         return weechat.WEECHAT_RC_ERROR
@@ -1549,27 +1822,32 @@ def update_direct_message_channels_name(server_id, command, rc, out, err):
 
     return weechat.WEECHAT_RC_OK
 
-def update_custom_emojis(data, command, rc, out, err):
-    server_id, page = data.split("|")
-    page = int(page)
-    server = servers[server_id]
+def update_channel_mute_status(server, member_data):
+    channel = server.get_channel(member_data["channel_id"])
+    if not channel:
+        return
 
-    if rc != 0:
-        server.print_error("An error occurred while updating custom emojis")
-        return weechat.WEECHAT_RC_ERROR
+    muted = member_data["notify_props"]["mark_unread"] != "all"
+    if not channel.loaded and not is_channel_load_deferred(channel, member_data):
+        channel.load(muted)
+    elif muted != channel.is_muted():
+        if muted:
+            channel.mute()
+        else:
+            channel.unmute()
 
-    response = json.loads(out)
+def is_channel_load_deferred(channel, member_data):
+    if not config.get_value("network", "lazy_channel_loading"):
+        return False
 
-    for emoji in response:
-        server.custom_emojis.append(emoji["name"])
+    if channel.buffer == weechat.current_buffer():
+        return False
 
-    if len(response) == 150:
-        EVENTROUTER.enqueue_request(
-            "run_get_custom_emojis",
-            server, page+1, "update_custom_emojis", "{}|{}".format(server.id, page+1)
-        )
+    # channels with something new are loaded now so that they show up in the hotlist
+    if member_data["mention_count"] or member_data["msg_count"] < channel.total_msg_count:
+        return False
 
-    return weechat.WEECHAT_RC_OK
+    return True
 
 def create_channel_from_channel_data(channel_data, server):
     if channel_data["type"] == "D":
@@ -1581,7 +1859,7 @@ def create_channel_from_channel_data(channel_data, server):
         if user_2_id in server.closed_channels:
             server.closed_channels[user_2_id] = channel_data["id"]
             return
-        if server.users[user_1_id].deleted or server.users[user_2_id].deleted:
+        if server.get_user(user_1_id).deleted or server.get_user(user_2_id).deleted:
             return
 
         channel = DirectMessagesChannel(server, **channel_data)
@@ -1610,11 +1888,16 @@ def create_channel_from_channel_data(channel_data, server):
 def buffer_switch_cb(data, signal, buffer):
     for server in servers.values():
         channel = server.get_channel_from_buffer(buffer)
+        if channel and not channel.loaded:
+            channel.load(channel.is_muted())
+        if channel and channel.is_loading():
+            EVENTROUTER.promote_requests(server.id, channel, PRIORITY_VISIBLE)
+        if channel:
+            channel.populate_nicklist()
         if channel and channel.users:
             channel.mark_as_read()
-            EVENTROUTER.enqueue_request(
-                "run_post_users_status_ids",
-                list(channel.users.keys()), server, "hydrate_channel_users_status_cb", "{}|{}".format(server.id, channel.id)
+            server.presence_batcher.request(
+                list(channel.users.keys()), PRIORITY_VISIBLE, hydrate_channel_users_status_cb, channel
             )
             break
 
@@ -1689,10 +1972,13 @@ def handle_multiline_message_cb(data, modifier, buffer, string):
 class User:
     def __init__(self, **kwargs):
         self.id = kwargs["id"]
+        self.status = None
+        self.update(**kwargs)
+
+    def update(self, **kwargs):
         self.username = kwargs["username"]
         self.first_name = kwargs["first_name"]
         self.last_name = kwargs["last_name"]
-        self.status = None
         self.deleted = kwargs["delete_at"] != 0
         self.color = weechat.info_get("nick_color_name", self.username)
 
@@ -1731,9 +2017,34 @@ class Server:
         self.reconnection_loop_hook = ""
         self.closed_channels = {}
         self.custom_emojis = []
+        self.cached_channel_ids = set()
+        self.bootstrap = None
+        self.tracer = StartupTracer(self)
+        self.ws_handled_events = 0
+        self.ws_unknown_events = {}
+        self.ws_wire_bytes = 0
+        self.ws_payload_bytes = 0
+        self.dirty_channels = set()
+        self.post_updates_hook = None
+        self.ws_connection_id = ""
+        self.ws_sequence = 0
+        self.ws_resuming = False
+        self.presence_batcher = PresenceBatcher(self)
+        self.user_directory = UserDirectory(self)
+        self.outbox = Outbox(self)
+        self.http_pool = None
 
         self._create_buffer()
 
+        pool_size = config.get_value("network", "connection_pool_size")
+        if pool_size and weechat.config_string(weechat.config_get("weechat.network.proxy_curl")):
+            # the pool connects directly, only URL transfers go through the proxy
+            self.print("Using WeeChat URL transfer through weechat.network.proxy_curl instead of the connection pool")
+        elif pool_size:
+            self.http_pool = HttpClientPool(self.id, self.url, pool_size)
+
+        self.cache = MetadataCache(self)
+
     def _create_buffer(self):
         # use "*" character so that the buffer is unique and gets sorted before all server buffers
         buffer_name = "wee_most.{}*".format(self.id)
@@ -1747,6 +2058,7 @@ class Server:
     def init_me(self, **kwargs):
         self.me = User(**kwargs)
         self.me.color = weechat.config_string(weechat.config_get("weechat.color.chat_nick_self"))
+        self.users[self.me.id] = self.me
 
         if kwargs["notify_props"]["first_name"] == "true":
             self.highlight_words.append(kwargs["first_name"])
@@ -1757,6 +2069,21 @@ class Server:
         if kwargs["notify_props"]["mention_keys"]:
             self.highlight_words.extend(kwargs["notify_props"]["mention_keys"].split(","))
 
+    def get_user(self, user_id):
+        return self.user_directory.get(user_id)
+
+    def refresh_users(self, old_nicks):
+        for channel in list(self.channels.values()):
+            if isinstance(channel, DirectMessagesChannel) and channel.user.deleted:
+                channel.unload()
+                self.remove_channel(channel.id)
+            else:
+                channel.refresh_users(old_nicks)
+
+        for team in self.teams.values():
+            for channel in team.channels.values():
+                channel.refresh_users(old_nicks)
+
     def print(self, message):
         weechat.prnt(self.buffer, message)
 
@@ -1812,7 +2139,7 @@ class Server:
             if isinstance(channel, DirectMessagesChannel) and channel.user.id == user_id:
                 return channel
 
-    def fetch_direct_message_channels_user_status(self, channel=None):
+    def fetch_direct_message_channels_user_status(self, priority, channel=None):
         user_ids = []
 
         if channel:
@@ -1821,10 +2148,7 @@ class Server:
             for channel in self.get_direct_messages_channels():
                 user_ids.append(channel.user.id)
 
-        EVENTROUTER.enqueue_request(
-            "run_post_users_status_ids",
-            user_ids, self, "update_direct_message_channels_name", self.id
-        )
+        self.presence_batcher.request(user_ids, priority, update_direct_message_channels_name, self)
 
     def get_post(self, post_id):
         for channel in self.channels.values():
@@ -1844,6 +2168,36 @@ class Server:
     def add_team(self, team):
         self.teams[team.id] = team
 
+    def schedule_post_updates(self, channel):
+        self.dirty_channels.add(channel)
+
+        if not self.post_updates_hook:
+            self.post_updates_hook = weechat.hook_timer(POST_UPDATE_DELAY_MS, 0, 1, "flush_post_updates_cb", self.id)
+
+    def flush_post_updates(self):
+        self.post_updates_hook = None
+
+        channels = self.dirty_channels
+        self.dirty_channels = set()
+
+        for channel in channels:
+            # might have been closed in the meantime
+            if self.get_channel(channel.id) is channel:
+                channel.flush_post_updates()
+
+    def prune_cached_channels(self, channel_ids):
+        # the channels left while away are still in the cache
+        left_channel_ids = list(self.cached_channel_ids - channel_ids)
+        self.cached_channel_ids = set()
+
+        for channel_id in left_channel_ids:
+            channel = self.get_channel(channel_id)
+            if channel:
+                channel.unload()
+                self.remove_channel(channel_id)
+
+        self.cache.delete("channels", left_channel_ids)
+
     def retrieve_2fa_token(self):
         try:
             out = subprocess.check_output(self.command_2fa, shell=True)
@@ -1860,6 +2214,12 @@ class Server:
             close_worker(self.worker)
         if self.reconnection_loop_hook:
             weechat.unhook(self.reconnection_loop_hook)
+        if self.post_updates_hook:
+            weechat.unhook(self.post_updates_hook)
+        if self.http_pool:
+            self.http_pool.close()
+        EVENTROUTER.remove_server(self.id)
+        self.cache.close()
 
         for channel in self.channels.values():
             channel.unload()
@@ -1894,6 +2254,8 @@ class Team:
         buffer_merge(self.buffer)
 
     def unload(self):
+        EVENTROUTER.cancel_requests(self.server.id, self)
+
         for channel in self.channels.values():
             channel.unload()
         weechat.buffer_close(self.buffer)
@@ -1921,371 +2283,1789 @@ def get_server_from_buffer(buffer):
 
     return servers[server_id]
 
-def get_buffer_user_status_cb(data, remaining_calls):
-    buffer = weechat.current_buffer()
+PRESENCE_BATCH_SIZE = 500
+PRESENCE_BATCH_INTERVAL_MS = 500
 
-    for server in servers.values():
-        channel = server.get_channel_from_buffer(buffer)
-        if channel and channel.users:
-            EVENTROUTER.enqueue_request(
-                "run_post_users_status_ids",
-                list(channel.users.keys()), server, "hydrate_channel_users_status_cb", "{}|{}".format(server.id, channel.id)
-            )
-            break
+class PresenceBatcher:
+    def __init__(self, server):
+        self.server = server
+        self.pending_user_ids = {}
+        self.waiters = []
+        self.batches = {}
+        self.last_batch_id = 0
+
+    def request(self, user_ids, priority, on_done, ctx):
+        for user_id in user_ids:
+            self.pending_user_ids[user_id] = min(priority, self.pending_user_ids.get(user_id, priority))
+
+        for waiter in self.waiters:
+            if waiter[0] == on_done and waiter[1] == ctx:
+                waiter[2].update(user_ids)
+                return
 
-    return weechat.WEECHAT_RC_OK
+        self.waiters.append([on_done, ctx, set(user_ids)])
 
-def get_direct_message_channels_user_status_cb(data, remaining_calls):
-    for server in servers.values():
-        server.fetch_direct_message_channels_user_status()
+    def flush(self):
+        if not self.pending_user_ids:
+            return
 
-    return weechat.WEECHAT_RC_OK
+        # most urgent users first, one bounded request per flush
+        user_ids = sorted(self.pending_user_ids, key=self.pending_user_ids.get)[:PRESENCE_BATCH_SIZE]
+        priority = self.pending_user_ids[user_ids[0]]
+        for user_id in user_ids:
+            del self.pending_user_ids[user_id]
 
-def connect_server_team_channel(channel_id, server):
-    EVENTROUTER.enqueue_request(
-        "run_get_channel",
-        channel_id, server, "connect_server_team_channel_cb", server.id
-    )
+        batch_user_ids = set(user_ids)
+        batch_waiters = []
+        for waiter in list(self.waiters):
+            if waiter[2] & batch_user_ids:
+                batch_waiters.append((waiter[0], waiter[1]))
+                waiter[2] -= batch_user_ids
+                if not waiter[2]:
+                    self.waiters.remove(waiter)
 
-def connect_server_team_channel_cb(server_id, command, rc, out, err):
-    server = servers[server_id]
+        self.last_batch_id += 1
+        self.batches[self.last_batch_id] = batch_waiters
 
-    if rc != 0:
-        server.print_error("An error occurred while connecting team channel")
-        return weechat.WEECHAT_RC_ERROR
+        EVENTROUTER.enqueue_request(
+            post_users_status_ids_request(user_ids, self.server, self.handle_batch, self.last_batch_id),
+            priority=priority
+        )
+
+    def handle_batch(self, batch_id, rc, out, err):
+        # every waiter ignores the users it is not interested in
+        for on_done, ctx in self.batches.pop(batch_id):
+            on_done(ctx, rc, out, err)
 
-    channel_data = json.loads(out)
-    if server.get_channel(channel_data["id"]):
         return weechat.WEECHAT_RC_OK
-    channel = create_channel_from_channel_data(channel_data, server)
 
-    if isinstance(channel, DirectMessagesChannel):
-        server.fetch_direct_message_channels_user_status(channel)
+    def cancel(self, ctx):
+        self.waiters = [ w for w in self.waiters if w[1] is not ctx ]
 
-    # this is only used for channel appearing so shouldn't be muted immediately
-    channel.load(muted=False)
+        for batch_id, batch_waiters in self.batches.items():
+            self.batches[batch_id] = [ w for w in batch_waiters if w[1] is not ctx ]
+
+# delay during which the updates of a post are gathered before it is rendered again
+POST_UPDATE_DELAY_MS = 100
+
+def flush_post_updates_cb(server_id, remaining_calls):
+    server = servers.get(server_id)
+    if server:
+        server.flush_post_updates()
 
     return weechat.WEECHAT_RC_OK
 
-def connect_server_team_channels_cb(server_id, command, rc, out, err):
-    server = servers[server_id]
+USER_BATCH_SIZE = 200
 
-    if rc != 0:
-        server.print_error("An error occurred while connecting team channels")
-        return weechat.WEECHAT_RC_ERROR
+class UserDirectory:
+    def __init__(self, server):
+        self.server = server
+        self.pending_user_ids = []
+        self.flush_hook = None
+        self.refresh_failed = False
+        self.refresh_remaining = 0
 
-    response = json.loads(out)
-    for channel_data in response:
-        if server.get_channel(channel_data["id"]):
-            continue
-        create_channel_from_channel_data(channel_data, server)
+    def get(self, user_id):
+        user = self.server.users.get(user_id)
+        if user:
+            return user
 
-    server.fetch_direct_message_channels_user_status()
+        # placeholder until the batch resolving it comes back
+        user = User(id=user_id, username=user_id[:8], first_name="", last_name="", delete_at=0)
+        self.server.users[user_id] = user
+        self.pending_user_ids.append(user_id)
 
-    EVENTROUTER.enqueue_request(
-        "run_get_user_channel_members",
-        server, 0, "update_channel_mute_status_cb", "{}|0".format(server.id)
-    )
+        if not self.flush_hook:
+            # the ids seen during the current callback are resolved together
+            self.flush_hook = weechat.hook_timer(1, 0, 1, "resolve_users_cb", self.server.id)
 
-    return weechat.WEECHAT_RC_OK
+        return user
 
-def connect_server_users_cb(data, command, rc, out, err):
-    server_id, page = data.split("|")
-    page = int(page)
-    server = servers[server_id]
+    def flush(self):
+        self.flush_hook = None
 
-    if rc != 0:
-        server.print_error("An error occurred while connecting users")
-        return weechat.WEECHAT_RC_ERROR
+        user_ids = self.pending_user_ids
+        self.pending_user_ids = []
 
-    response = json.loads(out)
-    for user in response:
-        if user["id"] == server.me.id:
-            server.users[user["id"]] = server.me
-        else:
-            server.users[user["id"]] = User(**user)
+        for i in range(0, len(user_ids), USER_BATCH_SIZE):
+            EVENTROUTER.enqueue_request(
+                post_users_ids_request(user_ids[i:i+USER_BATCH_SIZE], self.server, self.handle_users, None),
+                priority=PRIORITY_VISIBLE
+            )
 
-    if len(response) == 200:
-        EVENTROUTER.enqueue_request(
-            "run_get_users",
-            server, page+1, "connect_server_users_cb", "{}|{}".format(server.id, page+1)
-        )
-    else:
-        EVENTROUTER.enqueue_request(
-            "run_get_user_teams",
-            server, "connect_server_teams_cb", server.id
-        )
+    def handle_users(self, ctx, rc, out, err):
+        if rc != 0:
+            self.server.print_error("An error occurred while resolving users")
+            return weechat.WEECHAT_RC_ERROR
 
-    return weechat.WEECHAT_RC_OK
+        response = json.loads(out)
+        self.server.cache.save("users", response)
 
-def connect_server_preferences_cb(server_id, command, rc, out, err):
-    server = servers[server_id]
+        old_nicks = {}
+        for user_data in response:
+            user = self.server.users.get(user_data["id"])
+            if user:
+                old_nicks[user.id] = user.nick
+                user.update(**user_data)
 
-    if rc != 0:
-        server.print_error("An error occurred while connecting preferences")
-        return weechat.WEECHAT_RC_ERROR
+        self.server.refresh_users(old_nicks)
 
-    response = json.loads(out)
+        return weechat.WEECHAT_RC_OK
 
-    for pref in response:
-        if pref["category"] in ["direct_channel_show", "group_channel_show"] and pref["value"] == "false":
-            server.closed_channels[pref["name"]] = None # will contain channel id if encountered later
+    def refresh(self, user_ids):
+        sync_time = int(time.time() * 1000)
+        since = self.server.cache.get_since("users")
+        self.server.tracer.start("users")
 
-    return weechat.WEECHAT_RC_OK
+        self.refresh_failed = False
+        self.refresh_remaining = 0
 
-def connect_server_teams_cb(server_id, command, rc, out, err):
-    server = servers[server_id]
+        # only the users changed since the last sync are sent back
+        for i in range(0, len(user_ids), USER_BATCH_SIZE):
+            self.refresh_remaining += 1
+            EVENTROUTER.enqueue_request(
+                post_users_ids_request(user_ids[i:i+USER_BATCH_SIZE], self.server, self.handle_refreshed_users, sync_time, since)
+            )
 
-    if rc != 0:
-        server.print_error("An error occurred while connecting teams")
-        return weechat.WEECHAT_RC_ERROR
+        if not self.refresh_remaining:
+            self.server.cache.set_since("users", sync_time)
+            self.server.tracer.end("users")
 
-    response = json.loads(out)
+    def handle_refreshed_users(self, sync_time, rc, out, err):
+        self.refresh_remaining -= 1
+        if not self.refresh_remaining:
+            self.server.tracer.end("users")
 
-    for team_data in response:
-        team = Team(server, **team_data)
-        server.add_team(team)
+        if rc != 0:
+            self.refresh_failed = True
+        elif not self.refresh_remaining and not self.refresh_failed:
+            self.server.cache.set_since("users", sync_time)
 
-        EVENTROUTER.enqueue_request(
-            "run_get_user_team_channels",
-            team.id, server, "connect_server_team_channels_cb", server.id
-        )
+        return self.handle_users(None, rc, out, err)
+
+def resolve_users_cb(server_id, remaining_calls):
+    server = servers.get(server_id)
+    if server:
+        server.user_directory.flush()
 
     return weechat.WEECHAT_RC_OK
 
-def connect_server_team_cb(server_id, command, rc, out, err):
-    server = servers[server_id]
+# number of failures while connected before giving up on an outbox entry
+OUTBOX_MAX_ATTEMPTS = 5
 
-    if rc != 0:
-        server.print_error("An error occurred while connecting team")
-        return weechat.WEECHAT_RC_ERROR
+class Outbox:
+    def __init__(self, server):
+        self.server = server
+        self.file_path = weechat.info_get("weechat_data_dir", "") + "/wee_most_outbox_{}.json".format(server.id)
+        self.entries = []
+        self.request = None
 
-    team_data = json.loads(out)
+        try:
+            with open(self.file_path, "r") as outbox_file:
+                self.entries = json.load(outbox_file)
+        except (OSError, ValueError):
+            pass
 
-    team = Team(server, **team_data)
-    server.add_team(team)
+    def _save(self):
+        try:
+            if not self.entries:
+                if os.path.exists(self.file_path):
+                    os.remove(self.file_path)
+                return
+
+            # written aside first so that a crash can't leave a truncated outbox
+            with open(self.file_path + ".tmp", "w") as outbox_file:
+                json.dump(self.entries, outbox_file)
+            os.replace(self.file_path + ".tmp", self.file_path)
+        except OSError:
+            self.server.print_error("Failed to save outbox in {}".format(self.file_path))
+
+    def add(self, entry, buffer):
+        entry["attempts"] = 0
+        self.entries.append(entry)
+        self._save()
+
+        if entry["type"] == "post":
+            channel = self.server.get_channel(entry["channel_id"])
+            channel.write_pending_post(self._pending_post(entry))
+        elif not self.server.is_connected():
+            weechat.prnt(buffer, "Not connected, {} will be sent on reconnection".format(entry["type"]))
+
+        self.flush()
+
+    def add_post(self, post, buffer):
+        now = int(time.time() * 1000)
+        post["type"] = "post"
+        post["pending_post_id"] = "{}:{}".format(self.server.me.id, now)
+        post["create_at"] = now
+
+        self.add(post, buffer)
+
+    def _pending_post(self, entry):
+        return Post(
+            self.server,
+            id=entry["pending_post_id"],
+            root_id=entry.get("root_id", ""),
+            channel_id=entry["channel_id"],
+            message=entry["message"],
+            type="",
+            create_at=entry["create_at"],
+            edit_at=0,
+            user_id=self.server.me.id,
+            props={},
+        )
+
+    def flush(self):
+        # one at a time so that they are applied in order
+        if self.request or not self.entries or not self.server.is_connected():
+            return
+
+        entry = self.entries[0]
+        if entry["type"] == "post":
+            request = post_post_request(entry, self.server, self.handle_sent, entry)
+        elif entry["type"] == "reaction":
+            request = post_reaction_request(entry["emoji_name"], entry["post_id"], self.server, self.handle_sent, entry)
+        elif entry["type"] == "unreaction":
+            request = delete_reaction_request(entry["emoji_name"], entry["post_id"], self.server, self.handle_sent, entry)
+        else:
+            request = delete_post_request(entry["post_id"], self.server, self.handle_sent, entry)
+
+        self.request = request
+        EVENTROUTER.enqueue_request(request, priority=PRIORITY_INTERACTIVE)
+
+    def handle_sent(self, entry, rc, out, err):
+        status = self.request.status
+        self.request = None
+
+        if rc != 0:
+            if is_permanent_failure(status):
+                self.server.print_error("Cannot send {}: {}".format(entry["type"], err))
+                self._give_up(entry)
+                return weechat.WEECHAT_RC_ERROR
+
+            # failures while the connection is lost don't count
+            if self.server.is_connected():
+                entry["attempts"] += 1
+                if entry["attempts"] == 1:
+                    self.server.print_error("Failed to send {}, trying again: {}".format(entry["type"], err))
+
+            if entry["attempts"] < OUTBOX_MAX_ATTEMPTS:
+                self._save()
+                return weechat.WEECHAT_RC_ERROR
+
+            self.server.print_error("Cannot send {}, giving up after {} attempts".format(entry["type"], OUTBOX_MAX_ATTEMPTS))
+            self._give_up(entry)
+            return weechat.WEECHAT_RC_ERROR
+
+        if entry["type"] == "post":
+            post = Post(self.server, **json.loads(out))
+            if post.channel:
+                post.channel.confirm_pending_post(entry["pending_post_id"], post)
+
+        self.entries.remove(entry)
+        self._save()
+
+        self.flush()
+
+        return weechat.WEECHAT_RC_OK
+
+    def _give_up(self, entry):
+        if entry["type"] == "post":
+            channel = self.server.get_channel(entry["channel_id"])
+            if channel:
+                channel.fail_pending_post(self._pending_post(entry))
+
+        self.entries.remove(entry)
+        self._save()
+
+        # the following entries don't have to wait for this one anymore
+        self.flush()
+
+# bumped whenever the layout changes, caches of another version are recreated
+CACHE_VERSION = 1
+
+CACHE_TABLES = ["users", "teams", "channels", "emojis"]
+
+# only what is needed to build a user, the rest is left on the server
+CACHED_USER_FIELDS = ["id", "username", "first_name", "last_name", "delete_at", "update_at"]
+
+# deltas are asked from a bit before the last sync in case clocks are not in sync
+CACHE_SINCE_MARGIN = 5 * 60 * 1000
+
+class MetadataCache:
+    def __init__(self, server):
+        self.server = server
+        self.file_path = weechat.info_get("weechat_data_dir", "") + "/wee_most_cache_{}.sqlite".format(server.id)
+        self.db = None
+
+        try:
+            self.db = sqlite3.connect(self.file_path)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+
+            version = self.db.execute("PRAGMA user_version").fetchone()[0]
+            if version != CACHE_VERSION or self.get_meta("origin") != self._origin():
+                self._reset()
+        except sqlite3.Error:
+            server.print_error("Failed to open cache in {}".format(self.file_path))
+            self.db = None
+
+    def _origin(self):
+        # a cache is only valid for the same account on the same server
+        return [self.server.url, self.server.username]
+
+    def _reset(self):
+        with self.db:
+            for table in CACHE_TABLES + ["meta"]:
+                self.db.execute("DROP TABLE IF EXISTS {}".format(table))
+            for table in CACHE_TABLES:
+                self.db.execute("CREATE TABLE {} (id TEXT PRIMARY KEY, update_at INTEGER, data TEXT)".format(table))
+            self.db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.db.execute("INSERT INTO meta VALUES ('origin', ?)", (json.dumps(self._origin()),))
+            self.db.execute("PRAGMA user_version = {}".format(CACHE_VERSION))
+
+    def load(self, table):
+        if not self.db:
+            return []
+
+        try:
+            rows = self.db.execute("SELECT data FROM {}".format(table)).fetchall()
+        except sqlite3.Error:
+            self.server.print_error("Failed to read {} from cache".format(table))
+            return []
+
+        return [ json.loads(row[0]) for row in rows ]
+
+    def save(self, table, items, replace=False):
+        if not self.db:
+            return
+
+        if table == "users":
+            items = [ { k: item[k] for k in CACHED_USER_FIELDS if k in item } for item in items ]
+
+        try:
+            with self.db:
+                if replace:
+                    self.db.execute("DELETE FROM {}".format(table))
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO {} VALUES (?, ?, ?)".format(table),
+                    [ (item["id"], item.get("update_at", 0), json.dumps(item)) for item in items ]
+                )
+        except sqlite3.Error:
+            self.server.print_error("Failed to save {} in cache".format(table))
+
+    def delete(self, table, ids):
+        if not self.db:
+            return
+
+        try:
+            with self.db:
+                self.db.executemany("DELETE FROM {} WHERE id = ?".format(table), [ (id,) for id in ids ])
+        except sqlite3.Error:
+            self.server.print_error("Failed to delete {} from cache".format(table))
+
+    def get_meta(self, key, default=None):
+        if not self.db:
+            return default
+
+        try:
+            row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        except sqlite3.Error:
+            return default
+
+        if not row:
+            return default
+
+        return json.loads(row[0])
+
+    def set_meta(self, key, value):
+        if not self.db:
+            return
+
+        try:
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, json.dumps(value)))
+        except sqlite3.Error:
+            self.server.print_error("Failed to save {} in cache".format(key))
+
+    def get_since(self, key):
+        sync_time = self.get_meta("since_" + key)
+        if sync_time is None:
+            return 0
+
+        return max(sync_time - CACHE_SINCE_MARGIN, 0)
+
+    def set_since(self, key, sync_time):
+        self.set_meta("since_" + key, sync_time)
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+def flush_presence_batches_cb(data, remaining_calls):
+    for server in servers.values():
+        server.presence_batcher.flush()
+
+    return weechat.WEECHAT_RC_OK
+
+def get_buffer_user_status_cb(data, remaining_calls):
+    buffer = weechat.current_buffer()
+
+    for server in servers.values():
+        channel = server.get_channel_from_buffer(buffer)
+        if channel and channel.users:
+            server.presence_batcher.request(
+                list(channel.users.keys()), PRIORITY_POLLING, hydrate_channel_users_status_cb, channel
+            )
+            break
+
+    return weechat.WEECHAT_RC_OK
+
+def get_direct_message_channels_user_status_cb(data, remaining_calls):
+    for server in servers.values():
+        server.fetch_direct_message_channels_user_status(PRIORITY_POLLING)
+
+    return weechat.WEECHAT_RC_OK
+
+def connect_server_team_channel(channel_id, server):
+    EVENTROUTER.enqueue_request(
+        get_channel_request(channel_id, server, connect_server_team_channel_cb, server)
+    )
+
+def connect_server_team_channel_cb(server, rc, out, err):
+    if rc != 0:
+        server.print_error("An error occurred while connecting team channel")
+        return weechat.WEECHAT_RC_ERROR
+
+    channel_data = json.loads(out)
+    server.cache.save("channels", [channel_data])
+
+    if server.get_channel(channel_data["id"]):
+        return weechat.WEECHAT_RC_OK
+    channel = create_channel_from_channel_data(channel_data, server)
+
+    if isinstance(channel, DirectMessagesChannel):
+        server.fetch_direct_message_channels_user_status(PRIORITY_BACKGROUND, channel)
+
+    # this is only used for channel appearing so shouldn't be muted immediately
+    channel.load(muted=False)
+
+    return weechat.WEECHAT_RC_OK
+
+def connect_server_team_channels(team, on_done):
+    server = team.server
+    since = server.cache.get_since("team_channels_" + team.id)
+    sync_time = int(time.time() * 1000)
+
+    EVENTROUTER.enqueue_request(
+        get_user_team_channels_request(team.id, server, on_done, (team, sync_time), team, since)
+    )
+
+def create_or_update_channels(channels_data, server):
+    for channel_data in channels_data:
+        channel = server.get_channel(channel_data["id"])
+        if channel:
+            channel.update_properties(channel_data)
+        else:
+            create_channel_from_channel_data(channel_data, server)
+
+def connect_server_team_channels_cb(ctx, rc, response, err):
+    team, sync_time = ctx
+    server = team.server
+
+    if rc != 0:
+        server.print_error("An error occurred while connecting team channels")
+        return weechat.WEECHAT_RC_ERROR
+
+    server.cache.save("channels", response)
+    server.cache.set_since("team_channels_" + team.id, sync_time)
+    create_or_update_channels(response, server)
+
+    server.fetch_direct_message_channels_user_status(PRIORITY_BACKGROUND)
 
     EVENTROUTER.enqueue_request(
-        "run_get_user_team_channels",
-        team.id, server, "connect_server_team_channels_cb", server.id
+        get_user_channel_members_request(server, 0, update_channel_mute_status_cb, (server, 0))
     )
 
-    return weechat.WEECHAT_RC_OK
+    return weechat.WEECHAT_RC_OK
+
+def connect_server_team_cb(server, rc, out, err):
+    if rc != 0:
+        server.print_error("An error occurred while connecting team")
+        return weechat.WEECHAT_RC_ERROR
+
+    team_data = json.loads(out)
+    server.cache.save("teams", [team_data])
+
+    team = Team(server, **team_data)
+    server.add_team(team)
+
+    connect_server_team_channels(team, connect_server_team_channels_cb)
+
+    return weechat.WEECHAT_RC_OK
+
+def load_server_from_cache(server):
+    user_ids = []
+    for user_data in server.cache.load("users"):
+        if user_data["id"] != server.me.id:
+            server.users[user_data["id"]] = User(**user_data)
+            user_ids.append(user_data["id"])
+
+    prefs = []
+    for category, name in server.cache.get_meta("hidden_channels", []):
+        prefs.append({ "category": category, "name": name, "value": "false" })
+    apply_channel_show_preferences(server, prefs)
+
+    server.custom_emojis = [ emoji["name"] for emoji in server.cache.load("emojis") ]
+
+    for team_data in server.cache.load("teams"):
+        server.add_team(Team(server, **team_data))
+
+    for channel_data in server.cache.load("channels"):
+        if channel_data["team_id"] and channel_data["team_id"] not in server.teams:
+            continue
+        server.cached_channel_ids.add(channel_data["id"])
+        create_channel_from_channel_data(channel_data, server)
+
+    server.user_directory.refresh(user_ids)
+
+class Bootstrap:
+    def __init__(self, server):
+        self.server = server
+        self.stages = {}
+        self.started = set()
+        self.done = set()
+        self.channels_data = []
+        self.members_data = []
+        self.members_complete = False
+
+        # stages run as soon as the ones they depend on are done
+        self.add_stage("emojis", [], self.fetch_emojis)
+        self.add_stage("preferences", [], self.fetch_preferences)
+        self.add_stage("teams", [], self.fetch_teams)
+        self.add_stage("team_channels", [], self.fetch_team_channels)
+        self.add_stage("members", [], self.fetch_members)
+        # the channels known from the cache don't have to wait for the teams
+        self.add_stage("cached_channels", ["members"], self.hydrate_cached_channels)
+        self.add_stage("channels", ["teams", "team_channels", "preferences"], self.create_channels)
+        self.add_stage("hydrate", ["channels", "members"], self.hydrate_channels)
+        self.add_stage("connected", list(self.stages.keys()), self.connected)
+
+    def add_stage(self, name, dependencies, run):
+        self.stages[name] = (dependencies, run)
+
+    def start(self):
+        self._run_ready_stages()
+
+    def complete(self, name):
+        self.done.add(name)
+        self.server.tracer.end(name)
+        self._run_ready_stages()
+
+    def _run_ready_stages(self):
+        for name, (dependencies, run) in list(self.stages.items()):
+            if name in self.started:
+                continue
+            if all([ dependency in self.done for dependency in dependencies ]):
+                self.started.add(name)
+                self.server.tracer.start(name)
+                run()
+
+    def fetch_emojis(self):
+        EVENTROUTER.enqueue_request(
+            get_custom_emojis_request(self.server, 0, self.handle_emojis, (0, []))
+        )
+
+    def handle_emojis(self, ctx, rc, response, err):
+        page, emojis = ctx
+
+        if rc != 0:
+            self.server.print_error("An error occurred while updating custom emojis")
+            self.complete("emojis")
+            return weechat.WEECHAT_RC_ERROR
+
+        emojis.extend(response)
+
+        if len(response) == 150:
+            EVENTROUTER.enqueue_request(
+                get_custom_emojis_request(self.server, page+1, self.handle_emojis, (page+1, emojis))
+            )
+            return weechat.WEECHAT_RC_OK
+
+        # the cached ones stay in use until all the pages are there
+        self.server.custom_emojis = [ emoji["name"] for emoji in emojis ]
+        self.server.cache.save("emojis", emojis, replace=True)
+
+        self.complete("emojis")
+
+        return weechat.WEECHAT_RC_OK
+
+    def fetch_preferences(self):
+        EVENTROUTER.enqueue_request(
+            get_preferences_request(self.server, self.handle_preferences, None)
+        )
+
+    def handle_preferences(self, ctx, rc, response, err):
+        if rc != 0:
+            self.server.print_error("An error occurred while connecting preferences")
+            self.complete("preferences")
+            return weechat.WEECHAT_RC_ERROR
+
+        hidden_channels = []
+        for pref in response:
+            if pref["category"] in ["direct_channel_show", "group_channel_show"] and pref["value"] == "false":
+                hidden_channels.append([pref["category"], pref["name"]])
+
+        # only what changed since the cached preferences were applied
+        cached_hidden_channels = self.server.cache.get_meta("hidden_channels", [])
+        prefs = []
+        for category, name in hidden_channels:
+            if [category, name] not in cached_hidden_channels:
+                prefs.append({ "category": category, "name": name, "value": "false" })
+        for category, name in cached_hidden_channels:
+            if [category, name] not in hidden_channels:
+                prefs.append({ "category": category, "name": name, "value": "true" })
+
+        apply_channel_show_preferences(self.server, prefs)
+        self.server.cache.set_meta("hidden_channels", hidden_channels)
+
+        self.complete("preferences")
+
+        return weechat.WEECHAT_RC_OK
+
+    def fetch_teams(self):
+        EVENTROUTER.enqueue_request(
+            get_user_teams_request(self.server, self.handle_teams, None)
+        )
+
+    def handle_teams(self, ctx, rc, response, err):
+        if rc != 0:
+            self.server.print_error("An error occurred while connecting teams")
+            self.complete("teams")
+            return weechat.WEECHAT_RC_ERROR
+
+        self.server.cache.save("teams", response, replace=True)
+
+        team_ids = [ team_data["id"] for team_data in response ]
+        for team_id in list(self.server.teams.keys()):
+            if team_id not in team_ids: # left while away
+                team = self.server.teams.pop(team_id)
+                team.unload()
+
+        for team_data in response:
+            if team_data["id"] not in self.server.teams:
+                self.server.add_team(Team(self.server, **team_data))
+
+        self.complete("teams")
+
+        return weechat.WEECHAT_RC_OK
+
+    def fetch_team_channels(self):
+        # a single listing for the channels of all the teams
+        since = self.server.cache.get_since("channels")
+        sync_time = int(time.time() * 1000)
+
+        EVENTROUTER.enqueue_request(
+            get_user_channels_request(self.server, self.handle_team_channels, sync_time, since)
+        )
+
+    def handle_team_channels(self, sync_time, rc, response, err):
+        if rc != 0:
+            self.server.print_error("An error occurred while connecting team channels")
+            self.complete("team_channels")
+            return weechat.WEECHAT_RC_ERROR
+
+        self.server.cache.save("channels", response)
+        self.server.cache.set_since("channels", sync_time)
+        self.channels_data = response
+
+        self.complete("team_channels")
+
+        return weechat.WEECHAT_RC_OK
+
+    def fetch_members(self):
+        EVENTROUTER.enqueue_request(
+            get_user_channel_members_request(self.server, 0, self.handle_members, 0)
+        )
+
+    def handle_members(self, page, rc, out, err):
+        if rc != 0:
+            self.server.print_error("An error occurred while updating channel mute status")
+            self.complete("members")
+            return weechat.WEECHAT_RC_ERROR
+
+        response = json.loads(out)
+        self.members_data.extend(response)
+
+        if len(response) == 100:
+            EVENTROUTER.enqueue_request(
+                get_user_channel_members_request(self.server, page+1, self.handle_members, page+1)
+            )
+            return weechat.WEECHAT_RC_OK
+
+        self.members_complete = True
+        self.complete("members")
+
+        return weechat.WEECHAT_RC_OK
+
+    def create_channels(self):
+        # waits for the preferences so that hidden channels are never shown
+        channels_data = []
+        for channel_data in self.channels_data:
+            # the channels are split between the teams and the server
+            if not channel_data["team_id"] or channel_data["team_id"] in self.server.teams:
+                channels_data.append(channel_data)
+
+        create_or_update_channels(channels_data, self.server)
+        self.complete("channels")
+
+    def hydrate_cached_channels(self):
+        if self.server.cached_channel_ids:
+            self._hydrate()
+        self.complete("cached_channels")
+
+    def hydrate_channels(self):
+        self._hydrate()
+
+        if self.members_complete:
+            channel_ids = set([ member_data["channel_id"] for member_data in self.members_data ])
+            self.server.prune_cached_channels(channel_ids)
+
+        self.complete("hydrate")
+
+        # nothing might be left loading
+        self.server.tracer.check_hydrated()
+
+    def _hydrate(self):
+        self.server.fetch_direct_message_channels_user_status(PRIORITY_BACKGROUND)
+
+        for member_data in self.members_data:
+            update_channel_mute_status(self.server, member_data)
+
+    def connected(self):
+        self.server.print("Connected to {}".format(self.server.id))
+        self.complete("connected")
+
+# phases of the requests that are not part of the hydration of channels
+STARTUP_PHASE_ENDPOINTS = {
+    "POST /users/login": "login",
+    "GET /emoji": "emojis",
+    "POST /users/ids": "users",
+    "GET /users/me/teams": "teams",
+    "GET /users/me/channels": "team_channels",
+    "GET /users/me/preferences": "preferences",
+    "GET /users/me/channel_members": "members",
+}
+
+class PhaseTrace:
+    def __init__(self):
+        self.start = None
+        self.end = None
+        self.requests = 0
+        self.bytes = 0
+
+class StartupTracer:
+    def __init__(self, server):
+        self.server = server
+        self.enabled = config.get_value("network", "trace_startup")
+        self.start_time = time.time()
+        self.phases = {}
+        self.milestones = {}
+        self.file_path = weechat.info_get("weechat_data_dir", "") + "/wee_most_startup_{}.json".format(server.id)
+
+    def _elapsed(self):
+        # in milliseconds
+        return int((time.time() - self.start_time) * 1000)
+
+    def _phase(self, name):
+        if name not in self.phases:
+            self.phases[name] = PhaseTrace()
+        return self.phases[name]
+
+    def start(self, name):
+        if not self.enabled:
+            return
+
+        phase = self._phase(name)
+        if phase.start is None:
+            phase.start = self._elapsed()
+
+    def end(self, name):
+        if not self.enabled:
+            return
+
+        self.start(name)
+        self._phase(name).end = self._elapsed()
+
+    def milestone(self, name):
+        if self.enabled and name not in self.milestones:
+            self.milestones[name] = self._elapsed()
+
+    def record_request(self, request, out):
+        if not self.enabled:
+            return
+
+        phase = self._phase(STARTUP_PHASE_ENDPOINTS.get(request.endpoint, "hydration"))
+        phase.requests += 1
+        phase.bytes += len(out)
+
+    def channel_hydrated(self):
+        self.milestone("first_channel_hydrated")
+        self.check_hydrated()
+
+    def check_hydrated(self):
+        if not self.enabled or not self.server.bootstrap or "hydrate" not in self.server.bootstrap.done:
+            return
+
+        channels = list(self.server.channels.values())
+        for team in self.server.teams.values():
+            channels.extend(team.channels.values())
+
+        if any([ channel.is_loading() for channel in channels ]):
+            return
+
+        self.end("hydration")
+        self.milestone("all_channels_hydrated")
+        self.report()
+
+        # later loads are not part of the startup
+        self.enabled = False
+
+    def report(self):
+        self.server.print("Startup phases, in ms from the connection:")
+        for name, phase in self.phases.items():
+            self.server.print("  {}: {} to {}, {} requests, {}".format(
+                name, phase.start, phase.end, phase.requests, format_size(phase.bytes)
+            ))
+        for name, elapsed in self.milestones.items():
+            self.server.print("  {} at {}".format(name, elapsed))
+
+        trace = {
+            "server": self.server.id,
+            "start_time": self.start_time,
+            "settings": {
+                "max_concurrent_requests": config.get_value("network", "max_concurrent_requests"),
+                "connection_pool_size": config.get_value("network", "connection_pool_size"),
+                "lazy_channel_loading": config.get_value("network", "lazy_channel_loading"),
+            },
+            "phases": { name: vars(phase) for name, phase in self.phases.items() },
+            "milestones": self.milestones,
+        }
+
+        try:
+            with open(self.file_path, "w") as trace_file:
+                json.dump(trace, trace_file, indent=2)
+        except OSError:
+            self.server.print_error("Failed to write startup trace in {}".format(self.file_path))
+            return
+
+        self.server.print("Startup trace written in {}".format(self.file_path))
+
+def new_user_cb(server, rc, out, err):
+    if rc != 0:
+        server.print_error("An error occurred while adding a new user")
+        return weechat.WEECHAT_RC_ERROR
+
+    response = json.loads(out)
+    server.cache.save("users", [response])
+
+    user = server.users.get(response["id"])
+    if user:
+        user.update(**response)
+    else:
+        server.users[response["id"]] = User(**response)
+
+    return weechat.WEECHAT_RC_OK
+
+def connect_server_cb(server, rc, out, err):
+    if rc != 0:
+        server.print_error("An error occurred while connecting")
+        return weechat.WEECHAT_RC_ERROR
+
+    token_search = re.search("[tT]oken: (\w*)", out)
+
+    out = out.splitlines()[-1] # we remove the headers line
+    response = json.loads(out)
+
+    server.token = token_search.group(1)
+    server.init_me(**response)
+    server.tracer.end("login")
+
+    try:
+        worker = Worker(server)
+    except:
+        server.print_error("An error occurred while creating the websocket worker")
+        return weechat.WEECHAT_RC_ERROR
+
+    reconnection_loop_hook = weechat.hook_timer(5 * 1000, 0, 0, "reconnection_loop_cb", server.id)
+
+    server.worker = worker
+    server.reconnection_loop_hook = reconnection_loop_hook
+
+    # entries left from a previous session
+    server.outbox.flush()
+
+    # buffers are built from the cache right away, only the deltas are fetched after
+    load_server_from_cache(server)
+
+    server.bootstrap = Bootstrap(server)
+    server.bootstrap.start()
+
+    return weechat.WEECHAT_RC_OK
+
+def connect_server(server_id):
+    if server_id in servers:
+        server = servers[server_id]
+
+        if server != None and server.is_connected():
+            server.print_error("Already connected")
+            return weechat.WEECHAT_RC_ERROR
+
+        if server != None:
+            server.unload()
+            servers.pop(server_id)
+
+    try:
+        server = Server(server_id)
+    except ValueError as ve:
+        weechat.prnt("", weechat.prefix("error") + str(ve))
+        return weechat.WEECHAT_RC_ERROR
+
+    server.print("Connecting to {}".format(server_id))
+
+    servers[server_id] = server
+
+    server.tracer.start("login")
+    request = user_login_request(server, connect_server_cb, server)
+    if not request:
+        return weechat.WEECHAT_RC_ERROR
+
+    EVENTROUTER.enqueue_request(request)
+
+    return weechat.WEECHAT_RC_OK
+
+def disconnect_server(server_id):
+    server = servers[server_id]
+
+    if not server.is_connected():
+        server.print_error("Not connected")
+        return weechat.WEECHAT_RC_ERROR
+
+    rc = logout_user(server)
+
+    if rc == weechat.WEECHAT_RC_OK:
+        server.unload()
+        servers.pop(server_id)
+
+    return rc
+
+def singularity_cb(buffer, rc, out, err):
+    server = get_server_from_buffer(buffer)
+
+    if rc != 0:
+        server.print_error("An error occurred while performing a request")
+        return weechat.WEECHAT_RC_ERROR
+
+    return weechat.WEECHAT_RC_OK
+
+PRIORITY_INTERACTIVE = 0 # user actions, never held back by the in-flight window
+PRIORITY_VISIBLE = 1 # content of the displayed buffer
+PRIORITY_BACKGROUND = 2 # hydration of other buffers
+PRIORITY_POLLING = 3 # periodic refreshes
+
+# every few dispatches the oldest waiting request is served whatever its priority
+REQUEST_FAIRNESS_INTERVAL = 4
+
+# number of decoded responses kept for conditional requests, the least recently used are dropped
+ETAG_CACHE_SIZE = 64
+
+# maximum number of times a request is sent again after being rate limited
+RATE_LIMIT_MAX_ATTEMPTS = 10
+
+# failures worth retrying, None being a transfer error without any response
+RETRYABLE_STATUSES = [ None, 408, 500, 502, 503, 504 ]
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30
+
+class Histogram:
+    # powers of 2 buckets, from 1 ms to about 1 min
+    BUCKETS_COUNT = 17
+
+    def __init__(self):
+        self.buckets = [0] * Histogram.BUCKETS_COUNT
+        self.count = 0
+        self.max = 0
+
+    def add(self, value):
+        index = min(Histogram.BUCKETS_COUNT - 1, int(value).bit_length())
+        self.buckets[index] += 1
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        rank = p / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                # upper bound of the bucket
+                return min(self.max, 2 ** index)
+        return self.max
+
+    def render(self):
+        return "/".join([ str(int(self.percentile(p))) for p in [50, 90, 99] ])
+
+class EndpointStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.queue_wait = Histogram()
+        self.network = Histogram()
+        self.callback = Histogram()
+
+def format_size(size):
+    for unit in ["B", "KiB", "MiB"]:
+        if size < 1024:
+            return "{:.0f} {}".format(size, unit)
+        size /= 1024
+    return "{:.1f} GiB".format(size)
+
+def retry_delay(attempt):
+    # exponential backoff with jitter so that failed requests don't come back all at once
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def split_response_headers(out):
+    # there is a block of headers per response received, such as for a proxy or a 100 Continue,
+    # the last one being about the body
+    status = None
+    headers = {}
+    while out.startswith("HTTP/"):
+        block, _, out = out.partition("\r\n\r\n")
+        lines = block.split("\r\n")
+        try:
+            status = int(lines[0].split(" ")[1])
+        except (IndexError, ValueError):
+            status = None
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+    return status, headers, out
+
+def is_permanent_failure(status):
+    # the request was refused as such, sending it again won't help
+    return status is not None and 400 <= status < 500 and status != 429 and status not in RETRYABLE_STATUSES
+
+class Request:
+    def __init__(self, server, method, path, on_done, ctx=None, body=None, options={}, idempotent=False, conditional=False, decoded=False, owner=None):
+        self.server = server
+        self.method = method
+        self.path = path
+        self.body = body
+        self.options = options
+        self.conditional = conditional
+        self.decoded = decoded or conditional
+        # callbacks are called with their context, the response code, output and error,
+        # unless their owner (server, team or channel) is unloaded in the meantime,
+        # the output of decoded and conditional requests being already decoded from JSON
+        self.waiters = [(on_done, ctx, owner or server)]
+
+        self.id = None
+        self.status = None
+        self.priority = PRIORITY_BACKGROUND
+        self.cached = None
+        self.attempts = 0
+        self.enqueue_time = None
+        self.send_time = None
+
+        # only requests without side effects can be shared by several callers
+        self.key = None
+        if method == "GET" or idempotent:
+            self.key = (server.id, method, path, body, tuple(sorted(options.items())))
+
+    @property
+    def url(self):
+        return self.server.url + "/api/v4" + self.path
+
+    @property
+    def endpoint(self):
+        path = urllib.parse.urlsplit(self.path).path
+        path = re.sub(r"/[a-z0-9]{26}(?=/|$)", "/:id", path)
+        path = re.sub(r"/reactions/[^/]+$", "/reactions/:emoji_name", path)
+
+        return "{} {}".format(self.method, path)
+
+    @property
+    def headers_in_output(self):
+        # URL transfers only give response headers within the output, except for downloads
+        # and requests that handle them themselves
+        return "header" not in self.options and "file_out" not in self.options
+
+    def add_waiters(self, waiters):
+        for waiter in waiters:
+            if waiter not in self.waiters:
+                self.waiters.append(waiter)
+
+    def has_owner(self, owner):
+        return any([ w[2] is owner for w in self.waiters ])
+
+    def remove_owner(self, owner):
+        self.waiters = [ w for w in self.waiters if w[2] is not owner ]
+        return not self.waiters
+
+    def transfer_options(self):
+        options = {
+            "failonerror": "1",
+        }
+
+        if self.server.token:
+            options["httpheader"] = "Authorization: Bearer " + self.server.token
+        if self.body is not None:
+            options["postfields"] = self.body
+        if self.method not in ["GET", "POST"]:
+            options["customrequest"] = self.method
+
+        options.update(self.options)
+
+        return options
+
+class RateLimiter:
+    def __init__(self):
+        self.capacity = None # unknown until the server sends rate limit headers
+        self.tokens = 0
+        self.refill_rate = 0
+        self.last_refill_time = time.time()
+        self.blocked_until = 0
+
+    def _refill(self):
+        now = time.time()
+        if self.capacity is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill_time) * self.refill_rate)
+        self.last_refill_time = now
+
+    def is_blocked(self):
+        return time.time() < self.blocked_until
+
+    def has_token(self):
+        if self.is_blocked():
+            return False
+        if self.capacity is None:
+            return True
+
+        self._refill()
+        return self.tokens >= 1
+
+    def consume(self):
+        self._refill()
+        self.tokens -= 1
+
+    def block(self, delay):
+        self.blocked_until = max(self.blocked_until, time.time() + delay)
+
+    def update(self, headers, in_flight_count):
+        try:
+            limit = int(headers["x-ratelimit-limit"])
+            remaining = int(headers["x-ratelimit-remaining"])
+            reset = int(headers["x-ratelimit-reset"])
+        except (KeyError, ValueError):
+            return
+
+        self._refill()
+        self.capacity = limit
+        # the requests still in flight are not accounted in the remaining count yet
+        self.tokens = max(0, remaining - in_flight_count)
+        # reset is the time needed to get back to a full bucket
+        self.refill_rate = max(1, (limit - remaining) / reset if reset > 0 else limit)
+
+class EventRouter:
+    def __init__(self):
+        self.enqueued_requests = {}
+        self.enqueued_requests_by_key = {}
+        self.dispatch_counts = {}
+        self.in_flight_requests = {}
+        self.in_flight_requests_by_key = {}
+        self.in_flight_counts = {}
+        self.response_buffers = {}
+        self.response_sizes = {}
+        self.process_hooks = {}
+        self.delayed_requests = {}
+        self.rate_limiters = {}
+        self.etag_cache = OrderedDict()
+        self.stats = {}
+        self.last_request_id = 0
+
+    def enqueue_request(self, request, priority=PRIORITY_BACKGROUND):
+        server_id = request.server.id
+
+        if server_id not in self.enqueued_requests:
+            self.enqueued_requests[server_id] = [ deque() for _ in range(PRIORITY_POLLING + 1) ]
+            self.enqueued_requests_by_key[server_id] = {}
+            self.dispatch_counts[server_id] = 0
+            self.rate_limiters[server_id] = RateLimiter()
+
+        in_flight_request = self.in_flight_requests_by_key.get(request.key)
+        if in_flight_request:
+            # the response on its way is as good as a new one
+            in_flight_request.add_waiters(request.waiters)
+            return
+
+        queued_request = self.enqueued_requests_by_key[server_id].get(request.key)
+
+        if queued_request:
+            queued_request.add_waiters(request.waiters)
+            self._promote_request(server_id, queued_request, priority)
+        else:
+            request.enqueue_time = time.time()
+            request.priority = priority
+            self.enqueued_requests[server_id][priority].append(request)
+            if request.key:
+                self.enqueued_requests_by_key[server_id][request.key] = request
+
+        self.handle_next()
+
+    def _pop_next_request(self, server_id, lanes):
+        self.dispatch_counts[server_id] += 1
+
+        if self.dispatch_counts[server_id] % REQUEST_FAIRNESS_INTERVAL == 0:
+            # prevent lower lanes from starving behind a steady flow of higher ones
+            lane = min(filter(None, lanes), key=lambda l: l[0].enqueue_time)
+        else:
+            lane = next(filter(None, lanes))
+
+        return lane.popleft()
+
+    def _promote_request(self, server_id, request, priority):
+        lanes = self.enqueued_requests[server_id]
+
+        for lane in lanes[priority+1:]:
+            if request in lane:
+                lane.remove(request)
+                lanes[priority].append(request)
+                request.priority = priority
+                return
+
+    def promote_requests(self, server_id, owner, priority):
+        lanes = self.enqueued_requests.get(server_id)
+        if not lanes:
+            return
+
+        for lane in lanes[priority+1:]:
+            promoted = [ r for r in lane if r.has_owner(owner) ]
+            for request in promoted:
+                lane.remove(request)
+                lanes[priority].append(request)
+                request.priority = priority
+
+    def _dispatch(self, server_id, request):
+        if request.key:
+            del self.enqueued_requests_by_key[server_id][request.key]
+
+        self.submit_request(request)
+
+    def handle_next(self):
+        max_in_flight = config.get_value("network", "max_concurrent_requests")
+
+        for server_id, lanes in list(self.enqueued_requests.items()):
+            rate_limiter = self.rate_limiters[server_id]
+
+            while lanes[PRIORITY_INTERACTIVE] and not rate_limiter.is_blocked():
+                self._dispatch(server_id, lanes[PRIORITY_INTERACTIVE].popleft())
+
+            while any(lanes) and self.in_flight_counts.get(server_id, 0) < max_in_flight and rate_limiter.has_token():
+                self._dispatch(server_id, self._pop_next_request(server_id, lanes))
+
+    def submit_request(self, request):
+        in_flight_request = self.in_flight_requests_by_key.get(request.key)
+        if in_flight_request:
+            in_flight_request.add_waiters(request.waiters)
+            return
+
+        self.last_request_id += 1
+        request.id = str(self.last_request_id)
+        request.enqueue_time = request.enqueue_time or time.time()
+
+        self.in_flight_requests[request.id] = request
+        if request.key:
+            self.in_flight_requests_by_key[request.key] = request
+
+        self._send(request)
+
+    def _send(self, request):
+        server = request.server
+
+        request.attempts += 1
+        request.send_time = request.send_time or time.time()
+        self.in_flight_counts[server.id] = self.in_flight_counts.get(server.id, 0) + 1
+        self.rate_limiters[server.id].consume()
+
+        options = request.transfer_options()
+
+        # the cached response is held by the request in case it is dropped from the cache in the meantime
+        request.cached = self.etag_cache.get((server.id, request.url)) if request.conditional else None
+        if request.cached:
+            options["httpheader"] += "\nIf-None-Match: {}".format(request.cached[0])
+
+        if server.http_pool:
+            server.http_pool.submit(request.id, request.url, options, request.priority)
+            return
+
+        # taken out of the output once received, to keep track of the rate limits
+        if request.headers_in_output:
+            options["header"] = "1"
+
+        self.process_hooks[request.id] = weechat.hook_process_hashtable(
+            "url:" + request.url,
+            options,
+            REQUEST_TIMEOUT_MS,
+            "buffered_response_cb",
+            request.id
+        )
+
+    def _send_later(self, request_id, delay):
+        self.delayed_requests[request_id] = weechat.hook_timer(int(delay * 1000), 0, 1, "send_delayed_request_cb", request_id)
+
+    def send_delayed_request(self, request_id):
+        if self.delayed_requests.pop(request_id, None):
+            self._send(self.in_flight_requests[request_id])
+
+    def cancel_requests(self, server_id, owner):
+        for lane in self.enqueued_requests.get(server_id, []):
+            for request in list(lane):
+                if request.remove_owner(owner):
+                    lane.remove(request)
+                    if request.key:
+                        del self.enqueued_requests_by_key[server_id][request.key]
+
+        for request in list(self.in_flight_requests.values()):
+            if request.server.id == server_id and request.remove_owner(owner):
+                self._cancel_in_flight_request(request)
+
+        self.handle_next()
+
+    def _cancel_in_flight_request(self, request):
+        del self.in_flight_requests[request.id]
+        self.in_flight_requests_by_key.pop(request.key, None)
+        self._drop_response_buffer(request.id)
+
+        delayed_hook = self.delayed_requests.pop(request.id, None)
+        if delayed_hook:
+            # not counted as in flight while waiting to be sent again
+            weechat.unhook(delayed_hook)
+            return
+
+        self.in_flight_counts[request.server.id] -= 1
+
+        process_hook = self.process_hooks.pop(request.id, None)
+        if process_hook:
+            weechat.unhook(process_hook) # kills the transfer
+        elif request.server.http_pool:
+            request.server.http_pool.cancel(request.id)
 
-def new_user_cb(server_id, command, rc, out, err):
-    server = servers[server_id]
+    def remove_server(self, server_id):
+        for request in list(self.in_flight_requests.values()):
+            if request.server.id == server_id:
+                self._cancel_in_flight_request(request)
 
-    if rc != 0:
-        server.print_error("An error occurred while adding a new user")
-        return weechat.WEECHAT_RC_ERROR
+        self.enqueued_requests.pop(server_id, None)
+        self.enqueued_requests_by_key.pop(server_id, None)
+        self.dispatch_counts.pop(server_id, None)
+        self.in_flight_counts.pop(server_id, None)
+        self.rate_limiters.pop(server_id, None)
+        self.stats.pop(server_id, None)
 
-    response = json.loads(out)
-    server.users[response["id"]] = User(**response)
+        for cache_key in [ k for k in self.etag_cache if k[0] == server_id ]:
+            del self.etag_cache[cache_key]
 
-    return weechat.WEECHAT_RC_OK
+    def _drop_response_buffer(self, request_id):
+        self.response_sizes.pop(request_id, None)
+        return self.response_buffers.pop(request_id, [])
 
-def connect_server_cb(server_id, command, rc, out, err):
-    server = servers[server_id]
+    def buffered_response_cb(self, request_id, command, rc, out, err):
+        # chunks are joined only once the transfer is complete
+        self.response_buffers.setdefault(request_id, []).append(out)
+        self.response_sizes[request_id] = self.response_sizes.get(request_id, 0) + len(out)
 
-    if rc != 0:
-        server.print_error("An error occurred while connecting")
-        return weechat.WEECHAT_RC_ERROR
+        if self.response_sizes[request_id] > RESPONSE_MAX_SIZE:
+            self._drop_response_buffer(request_id)
 
-    token_search = re.search("[tT]oken: (\w*)", out)
+            hook = self.process_hooks.pop(request_id, None)
+            if hook and rc == weechat.WEECHAT_HOOK_PROCESS_RUNNING:
+                weechat.unhook(hook) # kills the transfer, so no more call for this request
 
-    out = out.splitlines()[-1] # we remove the headers line
-    response = json.loads(out)
+            # the same response would come again
+            return self.handle_response(request_id, 2, "", "Response exceeds {} bytes".format(RESPONSE_MAX_SIZE), retryable=False)
 
-    server.token = token_search.group(1)
-    server.init_me(**response)
+        if rc == weechat.WEECHAT_HOOK_PROCESS_RUNNING:
+            return weechat.WEECHAT_RC_OK
 
-    try:
-        worker = Worker(server)
-    except:
-        server.print_error("An error occurred while creating the websocket worker")
-        return weechat.WEECHAT_RC_ERROR
+        self.process_hooks.pop(request_id, None)
+        response = "".join(self._drop_response_buffer(request_id))
 
-    reconnection_loop_hook = weechat.hook_timer(5 * 1000, 0, 0, "reconnection_loop_cb", server.id)
+        status = None
+        headers = {}
+        request = self.in_flight_requests.get(request_id)
+        if request and request.headers_in_output:
+            status, headers, response = split_response_headers(response)
 
-    server.worker = worker
-    server.reconnection_loop_hook = reconnection_loop_hook
+        # failures may end the transfer before any header, their status is then only in the error message
+        match = re.search(r"returned error: (\d{3})", err)
+        if match:
+            status = int(match.group(1))
 
-    server.print("Connected to {}".format(server_id))
+        return self.handle_response(request_id, rc, response, err, status, headers)
 
-    EVENTROUTER.enqueue_request(
-        "run_get_custom_emojis",
-        server, 0, "update_custom_emojis", "{}|0".format(server.id)
-    )
+    def handle_response(self, request_id, rc, out, err, status=None, headers={}, retryable=True):
+        if request_id not in self.in_flight_requests: # server has been unloaded
+            return weechat.WEECHAT_RC_OK
 
-    EVENTROUTER.enqueue_request(
-        "run_get_users",
-        server, 0, "connect_server_users_cb", "{}|0".format(server.id)
-    )
+        request = self.in_flight_requests[request_id]
+        server_id = request.server.id
+        self.in_flight_counts[server_id] -= 1
 
-    EVENTROUTER.enqueue_request(
-        "run_get_preferences",
-        server, "connect_server_preferences_cb", server.id
-    )
+        rate_limiter = self.rate_limiters[server_id]
+        rate_limiter.update(headers, self.in_flight_counts[server_id])
 
-    return weechat.WEECHAT_RC_OK
+        if status == 429 and request.attempts < RATE_LIMIT_MAX_ATTEMPTS:
+            # nothing has been processed by the server, so it's safe to send it again
+            try:
+                delay = float(headers.get("retry-after") or headers.get("x-ratelimit-reset") or 1)
+            except ValueError:
+                delay = 1
+            rate_limiter.block(delay)
+            self._send_later(request_id, delay)
+            return weechat.WEECHAT_RC_OK
 
-def connect_server(server_id):
-    if server_id in servers:
-        server = servers[server_id]
+        if (rc != 0 and retryable and request.key and status in RETRYABLE_STATUSES
+                and request.attempts <= config.get_value("network", "request_retries")):
+            self._send_later(request_id, retry_delay(request.attempts))
+            return weechat.WEECHAT_RC_OK
 
-        if server != None and server.is_connected():
-            server.print_error("Already connected")
-            return weechat.WEECHAT_RC_ERROR
+        del self.in_flight_requests[request_id]
+        self.in_flight_requests_by_key.pop(request.key, None)
+
+        request.status = status
+
+        response = out
+        if request.decoded and rc == 0 and not request.conditional:
+            response = json.loads(out)
+        elif request.conditional and rc == 0:
+            # kept decoded, an unchanged response is neither sent nor parsed again
+            cache_key = (server_id, request.url)
+            if status == 304 and request.cached:
+                response = request.cached[1]
+                self.etag_cache[cache_key] = request.cached
+                self.etag_cache.move_to_end(cache_key)
+            else:
+                response = json.loads(out)
+                if "etag" in headers:
+                    self.etag_cache[cache_key] = (headers["etag"], response)
+                    self.etag_cache.move_to_end(cache_key)
 
-        if server != None:
-            server.unload()
-            servers.pop(server_id)
+            while len(self.etag_cache) > ETAG_CACHE_SIZE:
+                self.etag_cache.popitem(last=False)
 
-    try:
-        server = Server(server_id)
-    except ValueError as ve:
-        weechat.prnt("", weechat.prefix("error") + str(ve))
-        return weechat.WEECHAT_RC_ERROR
+        response_time = time.time()
 
-    server.print("Connecting to {}".format(server_id))
+        try:
+            for on_done, ctx, _ in request.waiters:
+                real_rc = on_done(ctx, rc, response, err)
+            return real_rc
+        finally:
+            self._record_stats(request, rc, out, response_time)
+
+            # a slot is free again, no need to wait for the next timer tick
+            self.handle_next()
+
+    def _record_stats(self, request, rc, out, response_time):
+        endpoint_stats = self.stats.setdefault(request.server.id, {}).setdefault(request.endpoint, EndpointStats())
+
+        request.server.tracer.record_request(request, out)
+
+        endpoint_stats.count += 1
+        endpoint_stats.bytes += len(out)
+        if rc != 0:
+            endpoint_stats.errors += 1
+
+        # in milliseconds
+        endpoint_stats.queue_wait.add((request.send_time - request.enqueue_time) * 1000)
+        endpoint_stats.network.add((response_time - request.send_time) * 1000)
+        endpoint_stats.callback.add((time.time() - response_time) * 1000)
+
+    def print_stats(self, server):
+        lanes = self.enqueued_requests.get(server.id, [])
+        server.print("Requests: {} queued, {} in flight, {} waiting for retry".format(
+            sum([ len(l) for l in lanes ]),
+            self.in_flight_counts.get(server.id, 0),
+            len([ r for r in self.delayed_requests if self.in_flight_requests[r].server is server ]),
+        ))
+
+        server_stats = self.stats.get(server.id, {})
+        if not server_stats:
+            return
 
-    servers[server_id] = server
+        server.print("Per endpoint, in ms as p50/p90/p99: queue wait, network, callback")
+        for endpoint, endpoint_stats in sorted(server_stats.items()):
+            server.print("  {}: {} requests, {} errors, {} | {}, {}, {}".format(
+                endpoint,
+                endpoint_stats.count,
+                endpoint_stats.errors,
+                format_size(endpoint_stats.bytes),
+                endpoint_stats.queue_wait.render(),
+                endpoint_stats.network.render(),
+                endpoint_stats.callback.render(),
+            ))
 
-    EVENTROUTER.enqueue_request(
-        "run_user_login",
-        server, "connect_server_cb", server.id
-    )
+def handle_queued_request_cb(data, remaining_calls):
+    EVENTROUTER.handle_next()
+    return weechat.WEECHAT_RC_OK
 
+def send_delayed_request_cb(request_id, remaining_calls):
+    EVENTROUTER.send_delayed_request(request_id)
     return weechat.WEECHAT_RC_OK
 
-def disconnect_server(server_id):
-    server = servers[server_id]
+class ResponseTooLargeError(Exception):
+    pass
 
-    if not server.is_connected():
-        server.print_error("Not connected")
-        return weechat.WEECHAT_RC_ERROR
+class FileWriteError(Exception):
+    pass
 
-    rc = logout_user(server)
+class TLSSessionHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, pool, *args, **kwargs):
+        super(TLSSessionHTTPSConnection, self).__init__(*args, **kwargs)
+        self.pool = pool
 
-    if rc == weechat.WEECHAT_RC_OK:
-        server.unload()
-        servers.pop(server_id)
+    def connect(self):
+        # same as HTTPSConnection.connect but resuming the last TLS session of the pool
+        http.client.HTTPConnection.connect(self)
 
-    return rc
+        server_hostname = self._tunnel_host or self.host
+        self.sock = self.pool.ssl_context.wrap_socket(self.sock, server_hostname=server_hostname, session=self.pool.tls_session)
 
-def singularity_cb(buffer, command, rc, out, err):
-    server = get_server_from_buffer(buffer)
+class HttpClientPool:
+    def __init__(self, server_id, url, size):
+        parsed_url = urllib.parse.urlsplit(url)
+        self.https = parsed_url.scheme == "https"
+        self.host = parsed_url.hostname
+        self.port = parsed_url.port
+        self.ssl_context = ssl.create_default_context() if self.https else None
+        self.tls_session = None
 
-    if rc != 0:
-        server.print_error("An error occurred while performing a request")
-        return weechat.WEECHAT_RC_ERROR
+        # jobs waiting for a free connection are taken by priority like enqueued requests
+        self.jobs = queue.PriorityQueue()
+        self.jobs_count = 0
+        self.results = queue.Queue()
+        self.cancelled_request_ids = set()
 
-    return weechat.WEECHAT_RC_OK
+        # worker threads can't use the WeeChat API, they wake up the main loop through a pipe
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        self.hook_results = weechat.hook_fd(self.read_fd, 1, 0, 0, "http_pool_results_cb", server_id)
 
-def build_buffer_cb_data(url, cb, cb_data):
-    return "{}|{}|{}".format(url, cb, cb_data)
+        self.threads_lock = threading.Lock()
+        self.threads_count = size
+        for _ in range(size):
+            threading.Thread(target=self._run, daemon=True).start()
 
-class EventRouter:
-    def __init__(self):
-        self.enqueued_requests = []
-        self.response_buffers = {}
+    def submit(self, request_id, url, options, priority=PRIORITY_BACKGROUND):
+        self.jobs_count += 1
+        self.jobs.put((priority, self.jobs_count, (request_id, url, options)))
 
-    def enqueue_request(self, method, *params):
-        self.enqueued_requests.append([method, params])
+    def cancel(self, request_id):
+        # skipped if not started yet, otherwise its result is ignored
+        self.cancelled_request_ids.add(request_id)
 
-    def handle_next(self):
-        if not self.enqueued_requests:
-            return
+    def close(self):
+        weechat.unhook(self.hook_results)
+        os.close(self.read_fd)
 
-        request = self.enqueued_requests.pop(0)
-        eval(request[0])(*request[1])
+        # the write end is closed by the last exiting thread
+        for _ in range(self.threads_count):
+            self.jobs_count += 1
+            self.jobs.put((PRIORITY_POLLING + 1, self.jobs_count, None))
 
-    def buffered_response_cb(self, data, command, rc, out, err):
-        arg_search = re.search("([^\|]*)\|([^\|]*)\|(.*)", data)
-        response_buffer_name = arg_search.group(1)
-        real_cb = arg_search.group(2)
-        real_data = arg_search.group(3)
+    def _connect(self):
+        timeout = REQUEST_TIMEOUT_MS / 1000
 
-        if not response_buffer_name in self.response_buffers:
-            self.response_buffers[response_buffer_name] = ""
+        if self.https:
+            return TLSSessionHTTPSConnection(self, self.host, self.port, timeout=timeout, context=self.ssl_context)
 
-        if rc == weechat.WEECHAT_HOOK_PROCESS_RUNNING:
-            self.response_buffers[response_buffer_name] += out
-            return weechat.WEECHAT_RC_OK
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
 
-        response = self.response_buffers[response_buffer_name] + out
-        del self.response_buffers[response_buffer_name]
+    def _run(self):
+        connection = None
 
-        return eval(real_cb)(real_data, command, rc, response, err)
+        while True:
+            _, _, job = self.jobs.get()
+            if job is None:
+                break
 
-def handle_queued_request_cb(data, remaining_calls):
-    EVENTROUTER.handle_next()
-    return weechat.WEECHAT_RC_OK
+            request_id, url, options = job
+            if request_id in self.cancelled_request_ids:
+                self.cancelled_request_ids.discard(request_id)
+                continue
 
-def run_get_user_teams(server, cb, cb_data):
-    url = server.url + "/api/v4/users/me/teams"
-    weechat.hook_process_hashtable(
-        "url:" + url,
-        {
-            "failonerror": "1",
-            "httpheader": "Authorization: Bearer " + server.token,
-        },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
-    )
+            connection, result = self._perform(connection, url, options)
 
-def run_get_team(team_id, server, cb, cb_data):
-    url = server.url + "/api/v4/teams/{}".format(team_id)
-    weechat.hook_process_hashtable(
-        "url:" + url,
-        {
-            "failonerror": "1",
-            "httpheader": "Authorization: Bearer " + server.token,
-        },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
-    )
+            self.results.put((request_id, url) + result)
+            try:
+                os.write(self.write_fd, b"x")
+            except OSError: # pool has been closed in the meantime
+                break
 
-def run_get_users(server, page, cb, cb_data):
-    url = server.url + "/api/v4/users?per_page=200&page={}".format(str(page))
-    weechat.hook_process_hashtable(
-        "url:" + url,
-        {
-            "failonerror": "1",
-            "httpheader": "Authorization: Bearer " + server.token,
-        },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
-    )
+        if connection:
+            connection.close()
 
-def run_get_user(server, user_id, cb, cb_data):
-    url = server.url + "/api/v4/users/{}".format(user_id)
-    weechat.hook_process_hashtable(
-        "url:" + url,
-        {
-            "failonerror": "1",
-            "httpheader": "Authorization: Bearer " + server.token,
-        },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
-    )
+        with self.threads_lock:
+            self.threads_count -= 1
+            if not self.threads_count:
+                os.close(self.write_fd)
 
-def run_get_custom_emojis(server, page, cb, cb_data):
-    url = server.url + "/api/v4/emoji?per_page=150&page={}".format(str(page))
-    weechat.hook_process_hashtable(
-        "url:" + url,
-        {
-            "failonerror": "1",
-            "httpheader": "Authorization: Bearer " + server.token,
-        },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
-    )
+    @staticmethod
+    def _read_body(response, file_out=None):
+        # downloads are written as they come, other responses are kept in memory up to a limit
+        if not file_out and int(response.getheader("Content-Length") or 0) > RESPONSE_MAX_SIZE:
+            raise ResponseTooLargeError("Response exceeds {} bytes".format(RESPONSE_MAX_SIZE))
+
+        chunks = []
+        size = 0
+        while True:
+            chunk = response.read(RESPONSE_CHUNK_SIZE)
+            if not chunk:
+                break
+
+            if file_out:
+                try:
+                    file_out.write(chunk)
+                except OSError as e:
+                    raise FileWriteError(str(e))
+                continue
+
+            size += len(chunk)
+            if size > RESPONSE_MAX_SIZE:
+                raise ResponseTooLargeError("Response exceeds {} bytes".format(RESPONSE_MAX_SIZE))
+
+            chunks.append(chunk)
+
+        return b"".join(chunks)
+
+    @staticmethod
+    def _download(response, file_out_path):
+        try:
+            file_out = open(file_out_path, "wb")
+        except OSError as e:
+            raise FileWriteError(str(e))
+
+        with file_out:
+            return HttpClientPool._read_body(response, file_out)
+
+    def _perform(self, connection, url, options):
+        parsed_url = urllib.parse.urlsplit(url)
+        path = parsed_url.path + ("?" + parsed_url.query if parsed_url.query else "")
+
+        headers = {}
+        for header in filter(None, options.get("httpheader", "").split("\n")):
+            name, _, value = header.partition(":")
+            headers[name.strip()] = value.strip()
+
+        method = "GET"
+        body = None
+        if "postfields" in options:
+            method = "POST"
+            body = options["postfields"].encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        method = options.get("customrequest", method)
+
+        # a kept-alive connection may have been closed by the server in the meantime,
+        # so a failure on a reused connection is given a second chance on a fresh one
+        for reused in [connection is not None, False]:
+            if connection is None:
+                connection = self._connect()
+
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                if "file_out" in options and response.status < 400:
+                    response_body = self._download(response, options["file_out"])
+                else:
+                    response_body = self._read_body(response)
+                break
+            except ResponseTooLargeError as e:
+                # the remaining of the body is not read, so the connection can't be reused
+                connection.close()
+                return None, (2, "", str(e), response.status, {})
+            except FileWriteError as e:
+                connection.close()
+                return None, (4, "", str(e), response.status, {})
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                connection = None
+                if not reused:
+                    return None, (2, "", str(e), None, {})
+
+        if self.https and connection.sock:
+            self.tls_session = connection.sock.session
+
+        if response.will_close:
+            connection.close()
+            connection = None
+
+        status = response.status
+        headers = { name.lower(): value for name, value in response.getheaders() }
+
+        # mimic the return code and output of a WeeChat URL transfer
+        if status >= 400 and options.get("failonerror") == "1":
+            return connection, (2, "", "HTTP error {} {}".format(status, response.reason), status, headers)
+
+        if "file_out" in options:
+            return connection, (0, "", "", status, headers)
+
+        out = response_body.decode("utf-8", errors="replace")
+
+        if options.get("header") == "1":
+            status_line = "HTTP/1.1 {} {}".format(response.status, response.reason)
+            header_lines = [ "{}: {}".format(name, value) for name, value in response.getheaders() ]
+            out = "\r\n".join([status_line] + header_lines + ["", out])
+
+        return connection, (0, out, "", status, headers)
+
+def http_pool_results_cb(server_id, fd):
+    server = servers.get(server_id)
+    if not server or not server.http_pool:
+        return weechat.WEECHAT_RC_OK
+
+    try:
+        while os.read(fd, 4096):
+            pass
+    except BlockingIOError:
+        pass
+
+    while True:
+        try:
+            request_id, url, rc, out, err, status, headers = server.http_pool.results.get_nowait()
+        except queue.Empty:
+            break
+
+        server.http_pool.cancelled_request_ids.discard(request_id)
+
+        EVENTROUTER.handle_response(request_id, rc, out, err, status, headers)
+
+    return weechat.WEECHAT_RC_OK
+
+def get_user_teams_request(server, on_done, ctx):
+    return Request(server, "GET", "/users/me/teams", on_done, ctx, conditional=True)
+
+def get_team_request(team_id, server, on_done, ctx):
+    return Request(server, "GET", "/teams/{}".format(team_id), on_done, ctx)
+
+def get_user_request(server, user_id, on_done, ctx):
+    return Request(server, "GET", "/users/{}".format(user_id), on_done, ctx)
+
+def get_custom_emojis_request(server, page, on_done, ctx):
+    return Request(server, "GET", "/emoji?per_page=150&page={}".format(str(page)), on_done, ctx, conditional=True)
 
 # Logging out synchronously for usage in shutdown function
 def logout_user(server):
@@ -2302,8 +4082,7 @@ def logout_user(server):
     server.print("Disconnected")
     return weechat.WEECHAT_RC_OK
 
-def run_user_login(server, cb, cb_data):
-    url = server.url + "/api/v4/users/login"
+def user_login_request(server, on_done, ctx):
     params = {
         "login_id": server.username,
         "password": server.password,
@@ -2312,49 +4091,31 @@ def run_user_login(server, cb, cb_data):
     if server.command_2fa:
         token = server.retrieve_2fa_token()
         if not token:
-            return weechat.WEECHAT_RC_ERROR
+            return None
         params["token"] = token
 
-    weechat.hook_process_hashtable(
-        "url:" + url,
-        {
-            "failonerror": "1",
-            "postfields": json.dumps(params),
-            "header": "1",
-        },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
-    )
+    return Request(server, "POST", "/users/login", on_done, ctx, body=json.dumps(params), options={ "header": "1" })
 
-def run_get_channel(channel_id, server, cb, cb_data):
-    url = server.url + "/api/v4/channels/{}".format(channel_id)
-    weechat.hook_process_hashtable(
-        "url:" + url,
-        {
-            "failonerror": "1",
-            "httpheader": "Authorization: Bearer " + server.token,
-        },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
-    )
+def get_channel_request(channel_id, server, on_done, ctx):
+    return Request(server, "GET", "/channels/{}".format(channel_id), on_done, ctx)
 
-def run_get_user_team_channels(team_id, server, cb, cb_data):
-    url = server.url + "/api/v4/users/me/teams/{}/channels".format(team_id)
-    weechat.hook_process_hashtable(
-        "url:" + url,
-        {
-            "failonerror": "1",
-            "httpheader": "Authorization: Bearer " + server.token,
-        },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
-    )
+def get_user_team_channels_request(team_id, server, on_done, ctx, owner=None, since=0):
+    path = "/users/me/teams/{}/channels".format(team_id)
+    if since:
+        path += "?since={}".format(since)
 
-def run_post_post(post, server, cb, cb_data):
-    url = server.url + "/api/v4/posts"
+    # a delta has a new URL every time, so there is never an ETag to send for it
+    return Request(server, "GET", path, on_done, ctx, conditional=not since, decoded=True, owner=owner)
+
+def get_user_channels_request(server, on_done, ctx, since=0):
+    path = "/users/me/channels"
+    if since:
+        path += "?since={}".format(since)
+
+    # a delta has a new URL every time, so there is never an ETag to send for it
+    return Request(server, "GET", path, on_done, ctx, conditional=not since, decoded=True)
+
+def post_post_request(post, server, on_done, ctx):
     params = {
         "channel_id": post["channel_id"],
         "message": post["message"],
@@ -2363,128 +4124,55 @@ def run_post_post(post, server, cb, cb_data):
     if "root_id" in post:
         params["root_id"] = post["root_id"]
 
-    weechat.hook_process_hashtable(
-        "url:" + url,
-        {
-            "failonerror": "1",
-            "httpheader": "Authorization: Bearer " + server.token,
-            "postfields": json.dumps(params),
-        },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
-    )
+    # the server ignores a post sent again with the same pending id
+    params["pending_post_id"] = post["pending_post_id"]
+
+    return Request(server, "POST", "/posts", on_done, ctx, body=json.dumps(params), idempotent=True)
 
-def run_post_command(team_id, channel_id, command, server, cb, cb_data):
-    url = server.url + "/api/v4/commands/execute"
+def post_command_request(team_id, channel_id, command, server, on_done, ctx):
     params = {
         "channel_id": channel_id,
         "team_id": team_id,
         "command": command,
     }
 
-    weechat.hook_process_hashtable(
-        "url:" + url,
-        {
-            "failonerror": "1",
-            "httpheader": "Authorization: Bearer " + server.token,
-            "postfields": json.dumps(params),
-        },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
-    )
+    return Request(server, "POST", "/commands/execute", on_done, ctx, body=json.dumps(params))
 
-def run_get_read_channel_posts(channel_id, server, cb, cb_data):
-    url = server.url + "/api/v4/users/me/channels/{}/posts/unread?limit_after=1".format(channel_id)
-    weechat.hook_process_hashtable(
-        "url:" + url,
-        {
-            "failonerror": "1",
-            "httpheader": "Authorization: Bearer " + server.token,
-        },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
-    )
+def get_read_channel_posts_request(channel_id, server, on_done, ctx, owner=None):
+    return Request(server, "GET", "/users/me/channels/{}/posts/unread?limit_after=1".format(channel_id), on_done, ctx, owner=owner)
 
-def run_get_channel_posts_after(post_id, channel_id, server, cb, cb_data):
+def get_channel_posts_after_request(post_id, channel_id, server, on_done, ctx, owner=None):
     if post_id:
-        url = server.url + "/api/v4/channels/{}/posts?after={}".format(channel_id, post_id)
+        path = "/channels/{}/posts?after={}".format(channel_id, post_id)
     else:
-        url = server.url + "/api/v4/channels/{}/posts".format(channel_id)
+        path = "/channels/{}/posts".format(channel_id)
 
-    weechat.hook_process_hashtable(
-        "url:" + url,
-        {
-            "failonerror": "1",
-            "httpheader": "Authorization: Bearer " + server.token,
-        },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
-    )
+    return Request(server, "GET", path, on_done, ctx, owner=owner)
 
-def run_get_channel_members(channel_id, server, page, cb, cb_data):
-    url = server.url + "/api/v4/channels/{}/members?per_page=200&page={}".format(channel_id, str(page))
-    weechat.hook_process_hashtable(
-        "url:" + url,
-        {
-            "failonerror": "1",
-            "httpheader": "Authorization: Bearer " + server.token,
-        },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
-    )
+def get_channel_members_request(channel_id, server, page, on_done, ctx, owner=None):
+    return Request(server, "GET", "/channels/{}/members?per_page=200&page={}".format(channel_id, str(page)), on_done, ctx, owner=owner)
 
-def run_get_user_channel_members(server, page, cb, cb_data):
-    url = server.url + "/api/v4/users/me/channel_members?pageSize=100&page={}".format(str(page))
-    weechat.hook_process_hashtable(
-        "url:" + url,
-        {
-            "failonerror": "1",
-            "httpheader": "Authorization: Bearer " + server.token,
-        },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
-    )
+def get_user_channel_members_request(server, page, on_done, ctx):
+    return Request(server, "GET", "/users/me/channel_members?pageSize=100&page={}".format(str(page)), on_done, ctx)
 
-def run_post_users_status_ids(user_ids, server, cb, cb_data):
-    url = server.url + "/api/v4/users/status/ids"
-    weechat.hook_process_hashtable(
-        "url:" + url,
-        {
-            "postfields": json.dumps(user_ids),
-            "failonerror": "1",
-            "httpheader": "Authorization: Bearer " + server.token,
-        },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
-    )
+def post_users_ids_request(user_ids, server, on_done, ctx, since=0):
+    path = "/users/ids"
+    if since:
+        path += "?since={}".format(since)
+
+    return Request(server, "POST", path, on_done, ctx, body=json.dumps(user_ids), idempotent=True)
+
+def post_users_status_ids_request(user_ids, server, on_done, ctx):
+    return Request(server, "POST", "/users/status/ids", on_done, ctx, body=json.dumps(user_ids), idempotent=True)
 
-def run_post_channel_view(channel_id, server, cb, cb_data):
-    url = server.url + "/api/v4/channels/members/me/view"
+def post_channel_view_request(channel_id, server, on_done, ctx, owner=None):
     params = {
         "channel_id": channel_id,
     }
 
-    weechat.hook_process_hashtable(
-        "url:" + url,
-        {
-            "postfields": json.dumps(params),
-            "failonerror": "1",
-            "httpheader": "Authorization: Bearer " + server.token,
-        },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
-    )
+    return Request(server, "POST", "/channels/members/me/view", on_done, ctx, body=json.dumps(params), idempotent=True, owner=owner)
 
-def run_post_reaction(emoji_name, post_id, server, cb, cb_data):
-    url = server.url + "/api/v4/reactions"
+def post_reaction_request(emoji_name, post_id, server, on_done, ctx):
     params = {
         "user_id": server.me.id,
         "post_id": post_id,
@@ -2492,85 +4180,75 @@ def run_post_reaction(emoji_name, post_id, server, cb, cb_data):
         "create_at": int(time.time()),
     }
 
-    weechat.hook_process_hashtable(
-        "url:" + url,
-        {
-            "postfields": json.dumps(params),
-            "failonerror": "1",
-            "httpheader": "Authorization: Bearer " + server.token,
-        },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
-    )
+    return Request(server, "POST", "/reactions", on_done, ctx, body=json.dumps(params))
 
-def run_delete_reaction(emoji_name, post_id, server, cb, cb_data):
-    url = server.url + "/api/v4/users/me/posts/{}/reactions/{}".format(post_id, emoji_name)
+def delete_reaction_request(emoji_name, post_id, server, on_done, ctx):
+    return Request(server, "DELETE", "/users/me/posts/{}/reactions/{}".format(post_id, emoji_name), on_done, ctx)
 
-    weechat.hook_process_hashtable(
-        "url:" + url,
-        {
-            "customrequest": "DELETE",
-            "failonerror": "1",
-            "httpheader": "Authorization: Bearer " + server.token,
-        },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
-    )
+def delete_post_request(post_id, server, on_done, ctx):
+    return Request(server, "DELETE", "/posts/{}".format(post_id), on_done, ctx)
 
-def run_delete_post(post_id, server, cb, cb_data):
-    url = server.url + "/api/v4/posts/{}".format(post_id)
+def get_file_request(file_id, file_out_path, server, on_done, ctx):
+    return Request(server, "GET", "/files/{}".format(file_id), on_done, ctx, options={ "file_out": file_out_path })
 
-    weechat.hook_process_hashtable(
-        "url:" + url,
-        {
-            "customrequest": "DELETE",
-            "failonerror": "1",
-            "httpheader": "Authorization: Bearer " + server.token,
-        },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
-    )
+def get_preferences_request(server, on_done, ctx):
+    return Request(server, "GET", "/users/me/preferences", on_done, ctx, conditional=True)
 
-def run_get_file(file_id, file_out_path, server, cb, cb_data):
-    url = server.url + "/api/v4/files/{}".format(file_id)
+# events decoded by the reader thread and not handled yet, the thread waits when it is full
+WS_QUEUE_SIZE = 1000
+WS_DEFLATE_EXTENSION = "permessage-deflate; client_max_window_bits"
+WS_DEFLATE_TAIL = b"\x00\x00\xff\xff"
 
-    weechat.hook_process_hashtable(
-        "url:" + url,
-        {
-            "failonerror": "1",
-            "file_out": file_out_path,
-            "httpheader": "Authorization: Bearer " + server.token,
-        },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
-    )
+class DeflateFrameBuffer(frame_buffer):
+    def __init__(self, recv_fn, skip_utf8_validation):
+        super().__init__(recv_fn, skip_utf8_validation)
+        self.compressed_message = False
 
-def run_get_preferences(server, cb, cb_data):
-    url = server.url + "/api/v4/users/me/preferences"
+    def recv_header(self):
+        super().recv_header()
+
+        # websocket-client rejects reserved bits, the message is inflated once complete
+        fin, rsv1, rsv2, rsv3, opcode, has_mask, length_bits = self.header
+        if rsv1:
+            self.compressed_message = True
+            self.header = (fin, 0, rsv2, rsv3, opcode, has_mask, length_bits)
+
+class DeflateWebSocket(WebSocket):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.frame_buffer = DeflateFrameBuffer(self._recv, kwargs.get("skip_utf8_validation", False))
+        self.inflater = None
+        self.server = None
+
+    def recv_data(self, control_frame=False):
+        opcode, data = super().recv_data(control_frame)
+        if opcode not in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY):
+            return opcode, data
+
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        self.server.ws_wire_bytes += len(data)
+        if self.frame_buffer.compressed_message:
+            self.frame_buffer.compressed_message = False
+            data = self.inflater.decompress(data + WS_DEFLATE_TAIL)
+        self.server.ws_payload_bytes += len(data)
+
+        return opcode, data
 
-    weechat.hook_process_hashtable(
-        "url:" + url,
-        {
-            "failonerror": "1",
-            "httpheader": "Authorization: Bearer " + server.token,
-        },
-        REQUEST_TIMEOUT_MS,
-        "buffered_response_cb",
-        build_buffer_cb_data(url, cb, cb_data)
-    )
 
 class Worker:
     def __init__(self, server):
         self.last_ping_time = 0
         self.last_pong_time = 0
+        self.reader_thread = config.get_value("network", "websocket_reader_thread")
+        self.hook_drain = None
 
         url = server.url.replace("http", "ws", 1) + "/api/v4/websocket"
-        self.ws = create_connection(url)
-        self.ws.sock.setblocking(0)
+        if server.ws_connection_id:
+            # the server replays what was missed if it still knows the connection
+            url += "?" + urllib.parse.urlencode({ "connection_id": server.ws_connection_id, "sequence_number": server.ws_sequence })
+        self.ws = self._connect(server, url)
 
         params = {
             "seq": 1,
@@ -2580,20 +4258,108 @@ class Worker:
             }
         }
 
-        self.hook_data_read = weechat.hook_fd(self.ws.sock.fileno(), 1, 0, 0, "receive_ws_callback", server.id)
-        self.ws.send(json.dumps(params))
+        if self.reader_thread:
+            self.events = queue.Queue(WS_QUEUE_SIZE)
+
+            # the reader thread can't use the WeeChat API, it wakes up the main loop through a pipe
+            self.read_fd, self.write_fd = os.pipe()
+            os.set_blocking(self.read_fd, False)
+            self.hook_data_read = weechat.hook_fd(self.read_fd, 1, 0, 0, "ws_events_cb", server.id)
+            self.ws.send(json.dumps(params))
+
+            threading.Thread(target=self._read, daemon=True).start()
+        else:
+            self.ws.sock.setblocking(0)
+            self.hook_data_read = weechat.hook_fd(self.ws.sock.fileno(), 1, 0, 0, "receive_ws_callback", server.id)
+            self.ws.send(json.dumps(params))
 
         self.hook_ping = weechat.hook_timer(5 * 1000, 0, 0, "ws_ping_cb", server.id)
 
+    @staticmethod
+    def _connect(server, url):
+        if not config.get_value("network", "websocket_compression"):
+            return create_connection(url)
+
+        try:
+            # utf-8 is checked after inflating, when the message is decoded
+            ws = create_connection(url, header=[ "Sec-WebSocket-Extensions: " + WS_DEFLATE_EXTENSION ],
+                                   class_=DeflateWebSocket, skip_utf8_validation=True)
+        except WebSocketBadStatusException as e:
+            # servers and proxies that don't handle the extension reject the request as malformed,
+            # other failures have nothing to do with it and are left to the reconnection loop
+            if e.status_code != 400:
+                raise
+            server.print_error("Websocket compression refused, connecting without it")
+            return create_connection(url)
+
+        ws.server = server
+        if "permessage-deflate" in ws.getheaders().get("sec-websocket-extensions", ""):
+            ws.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+
+        return ws
+
+    @staticmethod
+    def _decode_frame(opcode, data):
+        if opcode == ABNF.OPCODE_PONG:
+            return ("pong", time.time())
+
+        if data:
+            try:
+                return ("message", json.loads(data.decode("utf-8")))
+            except ValueError:
+                pass
+
+        return None
+
+    def next_event(self):
+        if self.reader_thread:
+            try:
+                return self.events.get_nowait()
+            except queue.Empty:
+                return None
+
+        while True:
+            try:
+                opcode, data = self.ws.recv_data(control_frame=True)
+            except SSLWantReadError:
+                return None
+            except (WebSocketConnectionClosedException, socket.error):
+                return None
+
+            event = self._decode_frame(opcode, data)
+            if event:
+                return event
+
+    def _read(self):
+        while True:
+            try:
+                opcode, data = self.ws.recv_data(control_frame=True)
+            except Exception: # whatever the reason, the connection can't be used anymore
+                break
+
+            event = self._decode_frame(opcode, data)
+            if not event:
+                continue
+
+            self.events.put(event)
+            try:
+                os.write(self.write_fd, b"x")
+            except OSError: # worker has been closed in the meantime
+                break
+
+        # the end of the pipe tells the main loop that the connection is gone
+        os.close(self.write_fd)
+        self.ws.shutdown()
+
 def rehydrate_server_buffer(server, buffer):
     channel = server.get_channel_from_buffer(buffer)
-    if not channel:
+    if not channel or not channel.loaded:
         return
     channel.set_loading(True)
 
     EVENTROUTER.enqueue_request(
-        "run_get_channel_posts_after",
-        channel.last_post_id, channel.id, server, "hydrate_channel_posts_cb", buffer
+        get_channel_posts_after_request(channel.last_post_id, channel.id, server, hydrate_channel_posts_cb, channel, channel),
+        priority=channel.request_priority()
     )
 
 def rehydrate_server_buffers(server):
@@ -2607,6 +4373,8 @@ def rehydrate_server_buffers(server):
 def reconnection_loop_cb(server_id, remaining_calls):
     server = servers[server_id]
     if server != None and server.is_connected():
+        # gives another chance to the entries that failed while connected
+        server.outbox.flush()
         return weechat.WEECHAT_RC_OK
 
     server.print("Reconnecting...")
@@ -2619,13 +4387,30 @@ def reconnection_loop_cb(server_id, remaining_calls):
 
     server.worker = new_worker
     server.print("Reconnected.")
-    rehydrate_server_buffers(server)
+    # buffers are synced on hello if the session could not be resumed
+    server.ws_resuming = True
+    server.outbox.flush()
     return weechat.WEECHAT_RC_OK
 
 def close_worker(worker):
     weechat.unhook(worker.hook_data_read)
     weechat.unhook(worker.hook_ping)
-    worker.ws.close()
+    if worker.hook_drain:
+        weechat.unhook(worker.hook_drain)
+
+    if not worker.reader_thread:
+        worker.ws.close()
+        return
+
+    os.close(worker.read_fd)
+
+    # wakes up the reader thread which then exits, making room in case it waits on a full queue
+    worker.ws.abort()
+    while True:
+        try:
+            worker.events.get_nowait()
+        except queue.Empty:
+            break
 
 def handle_lost_connection(server):
     server.print("Connection lost.")
@@ -2649,6 +4434,18 @@ def ws_ping_cb(server_id, remaining_calls):
 
     return weechat.WEECHAT_RC_OK
 
+def handle_hello_message(server, data, broadcast):
+    connection_id = data.get("connection_id", "")
+
+    resumed = connection_id and connection_id == server.ws_connection_id
+
+    if server.ws_resuming and not resumed:
+        rehydrate_server_buffers(server)
+    server.ws_resuming = False
+
+    if not resumed:
+        server.ws_connection_id = connection_id
+
 def handle_posted_message(server, data, broadcast):
     post = json.loads(data["post"])
 
@@ -2659,8 +4456,17 @@ def handle_posted_message(server, data, broadcast):
     if not channel or channel.is_loading():
         return
 
+    if not channel.loaded:
+        # the post is part of what gets loaded
+        channel.load(channel.is_muted())
+        return
+
     post = Post(server, **post)
-    channel.write_post(post)
+    if post.id in channel.posts: # already confirmed by the outbox
+        return
+
+    if not post.pending_post_id or not channel.confirm_pending_post(post.pending_post_id, post):
+        channel.write_post(post)
 
     if channel.buffer == weechat.current_buffer():
         post.channel.mark_as_read()
@@ -2674,7 +4480,7 @@ def handle_reaction_added_message(server, data, broadcast):
 
     post = channel.posts[reaction_data["post_id"]]
     post.add_reaction(Reaction(server, **reaction_data))
-    channel.update_post(post)
+    channel.queue_post_update(post.id)
 
 def handle_reaction_removed_message(server, data, broadcast):
     reaction_data = json.loads(data["reaction"])
@@ -2685,7 +4491,7 @@ def handle_reaction_removed_message(server, data, broadcast):
 
     post = channel.posts[reaction_data["post_id"]]
     post.remove_reaction(Reaction(server, **reaction_data))
-    channel.update_post(post)
+    channel.queue_post_update(post.id)
 
 def handle_post_edited_message(server, data, broadcast):
     post_data = json.loads(data["post"])
@@ -2714,6 +4520,8 @@ def handle_channel_member_updated_message(server, data, broadcast):
 
 def handle_channel_updated_message(server, data, broadcast):
     channel_data = json.loads(data["channel"])
+    server.cache.save("channels", [channel_data])
+
     channel = server.get_channel(channel_data["id"])
     if not channel:
         return
@@ -2743,8 +4551,7 @@ def handle_group_added_message(server, data, broadcast):
 
 def handle_new_user_message(server, data, broadcast):
     EVENTROUTER.enqueue_request(
-        "run_get_user",
-        server, data["user_id"], "new_user_cb", server.id
+        get_user_request(server, data["user_id"], new_user_cb, server)
     )
 
 def handle_user_removed_message(server, data, broadcast):
@@ -2752,20 +4559,21 @@ def handle_user_removed_message(server, data, broadcast):
     if data["remover_id"] == server.me.id: # we are leaving the channel
         channel.unload()
         server.remove_channel(channel.id)
+        server.cache.delete("channels", [channel.id])
     else:
         channel.remove_user(data["remover_id"])
 
 def handle_added_to_team_message(server, data, broadcast):
     # cannot test but probably this event is only triggered on own user
     EVENTROUTER.enqueue_request(
-        "run_get_team",
-        data["team_id"], server, "connect_server_team_cb", server.id
+        get_team_request(data["team_id"], server, connect_server_team_cb, server)
     )
 
 def handle_leave_team_message(server, data, broadcast):
     # cannot test but probably this event is only triggered on own user
     team = server.teams.pop(data["team_id"])
     team.unload()
+    server.cache.delete("teams", [team.id])
 
 def handle_status_change_message(server, data, broadcast):
     # this event seems only to be triggered on own user
@@ -2788,8 +4596,9 @@ def handle_status_change_message(server, data, broadcast):
         user_dm_channel.set_status(user.status)
 
 def handle_preferences_changed_message(server, data, broadcast):
-    prefs = json.loads(data["preferences"])
+    apply_channel_show_preferences(server, json.loads(data["preferences"]))
 
+def apply_channel_show_preferences(server, prefs):
     for pref in prefs:
         if pref["category"] in ["direct_channel_show", "group_channel_show"]:
             if pref["value"] == "false":
@@ -2811,33 +4620,128 @@ def handle_preferences_changed_message(server, data, broadcast):
                 if pref["name"] in server.closed_channels:
                     del server.closed_channels[pref["name"]]
 
+WS_EVENT_HANDLERS = {
+    "hello": handle_hello_message,
+    "posted": handle_posted_message,
+    "reaction_added": handle_reaction_added_message,
+    "reaction_removed": handle_reaction_removed_message,
+    "post_edited": handle_post_edited_message,
+    "post_deleted": handle_post_deleted_message,
+    "channel_created": handle_channel_created_message,
+    "channel_member_updated": handle_channel_member_updated_message,
+    "channel_updated": handle_channel_updated_message,
+    "channel_viewed": handle_channel_viewed_message,
+    "user_added": handle_user_added_message,
+    "direct_added": handle_direct_added_message,
+    "group_added": handle_group_added_message,
+    "new_user": handle_new_user_message,
+    "user_removed": handle_user_removed_message,
+    "added_to_team": handle_added_to_team_message,
+    "leave_team": handle_leave_team_message,
+    "status_change": handle_status_change_message,
+    "preferences_changed": handle_preferences_changed_message,
+}
+
 def receive_ws_callback(server_id, data):
     server = servers[server_id]
+    drain_ws_events(server)
+
+    return weechat.WEECHAT_RC_OK
+
+def handle_ws_message(server, message):
+    # replies to our own actions have no event
+    if "event" not in message:
+        return
+
+    event = message["event"]
+    handler = WS_EVENT_HANDLERS.get(event)
+
+    if "seq" in message:
+        # hello starts the sequence of a new connection, a resumed one goes on numbering
+        new_connection = event == "hello" and message["data"].get("connection_id", "") != server.ws_connection_id
+        if not new_connection and message["seq"] != server.ws_sequence:
+            server.print("Missed events from the server")
+            rehydrate_server_buffers(server)
+        server.ws_sequence = message["seq"] + 1
+
+    if not handler:
+        server.ws_unknown_events[event] = server.ws_unknown_events.get(event, 0) + 1
+        return
+
+    server.ws_handled_events += 1
+    handler(server, message["data"], message["broadcast"])
+
+def print_ws_stats(server):
+    unknown_events = ", ".join([ "{} {}".format(count, event) for event, count in sorted(server.ws_unknown_events.items()) ])
+    server.print("Websocket events: {} handled, {} unknown{}".format(
+        server.ws_handled_events,
+        sum(server.ws_unknown_events.values()),
+        " ({})".format(unknown_events) if unknown_events else "",
+    ))
+    if server.ws_wire_bytes:
+        server.print("Websocket traffic: {} received, {} decompressed".format(
+            format_size(server.ws_wire_bytes),
+            format_size(server.ws_payload_bytes),
+        ))
+
+def ws_events_cb(server_id, fd):
+    server = servers[server_id]
+
+    connection_lost = False
+    try:
+        while True:
+            if not os.read(fd, 4096):
+                connection_lost = True
+                break
+    except BlockingIOError:
+        pass
+
+    if not connection_lost:
+        drain_ws_events(server)
+        return weechat.WEECHAT_RC_OK
+
+    # what was received before is still handled
     worker = server.worker
+    while server.worker is worker and not worker.events.empty():
+        drain_ws_events(server)
 
-    while True:
-        try:
-            opcode, data = worker.ws.recv_data(control_frame=True)
-        except SSLWantReadError:
-            return weechat.WEECHAT_RC_OK
-        except (WebSocketConnectionClosedException, socket.error) as e:
-            return weechat.WEECHAT_RC_OK
+    if server.worker is worker:
+        handle_lost_connection(server)
 
-        if opcode == ABNF.OPCODE_PONG:
-            worker.last_pong_time = time.time()
-            server.worker = worker
-            return weechat.WEECHAT_RC_OK
+    return weechat.WEECHAT_RC_OK
 
-        if data:
-            message = json.loads(data.decode("utf-8"))
-            if "event" in message:
-                handler_function_name = "handle_{}_message".format(message["event"])
-                if handler_function_name not in globals():
-                    return weechat.WEECHAT_RC_OK
-                globals()[handler_function_name](server, message["data"], message["broadcast"])
+def ws_drain_cb(server_id, remaining_calls):
+    server = servers.get(server_id)
+    if server and server.worker:
+        server.worker.hook_drain = None
+        drain_ws_events(server)
 
     return weechat.WEECHAT_RC_OK
 
+def drain_ws_events(server):
+    worker = server.worker
+    deadline = time.time() + config.get_value("network", "websocket_drain_time") / 1000
+    remaining = config.get_value("network", "websocket_drain_count")
+
+    while remaining and time.time() < deadline:
+        event = worker.next_event()
+        if not event:
+            return
+
+        remaining -= 1
+        kind, value = event
+        if kind == "pong":
+            worker.last_pong_time = value
+        else:
+            handle_ws_message(server, value)
+
+        if server.worker is not worker:
+            return
+
+    # the rest is handled on the next tick so that the input stays responsive
+    if not worker.hook_drain:
+        worker.hook_drain = weechat.hook_timer(1, 0, 1, "ws_drain_cb", server.id)
+
 EVENTROUTER = EventRouter()
 
 buffered_response_cb = EVENTROUTER.buffered_response_cb
@@ -2850,6 +4754,9 @@ default_emojis = []
 
 REQUEST_TIMEOUT_MS = 30 * 1000
 
+RESPONSE_MAX_SIZE = 64 * 1024 * 1024
+RESPONSE_CHUNK_SIZE = 64 * 1024
+
 mentions = ["@here", "@channel", "@all"]
 
 WEECHAT_SCRIPT_NAME = "wee_most"
@@ -2899,6 +4806,7 @@ weechat.hook_signal("buffer_switch", "buffer_switch_cb", "")
 weechat.hook_timer(int(0.2 * 1000), 0, 0, "handle_queued_request_cb", "")
 weechat.hook_timer(60 * 1000, 0, 0, "get_buffer_user_status_cb", "")
 weechat.hook_timer(60 * 1000, 0, 0, "get_direct_message_channels_user_status_cb", "")
+weechat.hook_timer(PRESENCE_BATCH_INTERVAL_MS, 0, 0, "flush_presence_batches_cb", "")
 weechat.hook_config("irc.look.server_buffer", "config_server_buffer_cb", "")
 
 weechat.hook_hsignal("mattermost_cursor_insert_post_id", "chat_line_event_cb", "insert_post_id")